@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+benchmarks for the redaction path of filtered_logger
+
+    ./benchmark.py                     run every case and print the table
+    ./benchmark.py --save base.json    also store the results as a baseline
+    ./benchmark.py --compare base.json exit 1 if a case got slower than
+                                       the baseline by more than --threshold
+
+benchmark_baseline.json holds the results of the current code; compare
+against it on the same machine, or save a local baseline first.
+"""
+import argparse
+import io
+import json
+import logging
+import platform
+import sys
+import timeit
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+from filtered_logger import (RedactingFormatter, _row_renderer,
+                             filter_datum)
+
+FIELD_COUNTS = (1, 5, 50, 500)
+SEPARATOR = RedactingFormatter.SEPARATOR
+REDACTION = RedactingFormatter.REDACTION
+
+
+def make_fields(count: int) -> List[str]:
+    """ field names; the first five are the real PII_FIELDS """
+    real = ["name", "email", "password", "ssn", "phone"]
+    return (real + ['field{}'.format(i) for i in range(count)])[:count]
+
+
+def make_message(fields: List[str], size: int, matching: bool = True) -> str:
+    """
+    a `key=value;` message of roughly size characters; keys cycle
+    through fields, or through unknown keys when matching is False
+    """
+    keys = fields if matching else ['other{}'.format(i) for i in range(8)]
+    parts = []
+    length = 0
+    i = 0
+    while length < size:
+        part = '{}=value-{:04d}{}'.format(keys[i % len(keys)], i, SEPARATOR)
+        parts.append(part)
+        length += len(part)
+        i += 1
+    return ''.join(parts)
+
+
+def measure(func: Callable[[], object], repeat: int = 5) -> Dict[str, float]:
+    """
+    best ops/sec over repeat runs, the bytes allocated by one call (the
+    peak of traced memory above what was in use before it, averaged over
+    calls) and the bytes still held after it (leaked or cached)
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat, number)) / number
+
+    calls = min(number, 1000)
+    tracemalloc.start()
+    func()
+    allocated = 0
+    before = tracemalloc.take_snapshot()
+    for _ in range(calls):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        func()
+        allocated += tracemalloc.get_traced_memory()[1] - current
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = sum(stat.size_diff for stat in after.compare_to(
+        before, 'filename'))
+    return {'ops_per_sec': 1 / best,
+            'alloc_bytes_per_op': allocated / calls,
+            'retained_bytes_per_op': retained / calls}
+
+
+def cases() -> List[Tuple[str, Callable[[], object]]]:
+    """ every benchmark case as (name, zero-argument callable) """
+    result = []
+    for count in FIELD_COUNTS:
+        fields = make_fields(count)
+        for label, size, matching in (('short', 64, True),
+                                      ('4kb', 4096, True),
+                                      ('nomatch', 4096, False)):
+            message = make_message(fields, size, matching)
+            result.append((
+                'filter_datum/{}/{}'.format(count, label),
+                lambda f=fields, m=message: filter_datum(f, REDACTION, m,
+                                                         SEPARATOR)))
+
+        formatter = RedactingFormatter(fields)
+        record = logging.LogRecord('user_data', logging.INFO, __file__, 0,
+                                   make_message(fields, 256), None, None)
+        result.append(('format/{}'.format(count),
+                       lambda f=formatter, r=record: f.format(r)))
+
+    headers = ['name', 'email', 'phone', 'ssn', 'password', 'ip',
+               'last_login', 'user_agent']
+    row = ('Marlene Wood', 'hwestiii@att.net', '(473) 401-4253',
+           '261-72-6780', 'K5?BMNv', '60ed:c396:2ff:244:bbd0:9208:26f2:93ea',
+           '2019-11-14 06:14:24', 'Mozilla/5.0 (Windows NT 10.0; Win64)')
+    render = _row_renderer(headers)
+    result.append(('row_format', lambda: render(row)))
+
+    logger = logging.Logger('user_data', logging.INFO)
+    handler = logging.StreamHandler(io.StringIO())
+    handler.setFormatter(RedactingFormatter(make_fields(5)))
+    logger.addHandler(handler)
+
+    def emit():
+        handler.stream.seek(0)
+        handler.stream.truncate()
+        logger.info(render(row))
+    result.append(('emit', emit))
+    return result
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict],
+            threshold: float) -> List[str]:
+    """ names of the cases slower than baseline by more than threshold """
+    slower = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if current['ops_per_sec'] < previous['ops_per_sec'] * (1 - threshold):
+            slower.append(name)
+    return slower
+
+
+def main() -> int:
+    """ runs the suite according to the command line """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--save', metavar='FILE')
+    parser.add_argument('--compare', metavar='FILE')
+    parser.add_argument('--threshold', type=float, default=0.10)
+    parser.add_argument('--filter', default='',
+                        help='only run cases whose name contains this')
+    args = parser.parse_args()
+
+    results = {}
+    for name, func in cases():
+        if args.filter not in name:
+            continue
+        results[name] = measure(func)
+        print('{:<28} {:>14,.0f} ops/s {:>10,.0f} B/op {:>8,.0f} B kept/op'
+              .format(name, results[name]['ops_per_sec'],
+                      results[name]['alloc_bytes_per_op'],
+                      results[name]['retained_bytes_per_op']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'results': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+        slower = compare(results, baseline, args.threshold)
+        for name in slower:
+            print('REGRESSION {}: {:,.0f} -> {:,.0f} ops/s'.format(
+                name, baseline[name]['ops_per_sec'],
+                results[name]['ops_per_sec']))
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,11 +2,26 @@
 """
 filtered _logger file
 """
+import copy
+import gzip
+import hashlib
+import hmac
+import json
+import queue
+import random
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import re
-from typing import List
+import threading
+from functools import lru_cache, partial
+from typing import Any, Callable, Iterator, List, Optional, Pattern, Tuple
 import logging
 from logging import StreamHandler
+from logging.handlers import QueueHandler
 import os
+import sys
+import time
 import mysql.connector
 
 PII_FIELDS = ("name", "email", "password", "ssn", "phone")
@@ -14,50 +29,680 @@ PII_FIELDS = ("name", "email", "password", "ssn", "phone")
 
 class RedactingFormatter(logging.Formatter):
     """ Redacting Formatter class
+
+        With a pseudonym_key, values are replaced by a keyed HMAC token
+        instead of REDACTION, so equal values keep matching across
+        lines; the last cache_size tokens are memoized.
         """
 
     REDACTION = "***"
     FORMAT = "[HOLBERTON] %(name)s %(levelname)s %(asctime)-15s: %(message)s"
     SEPARATOR = ";"
+    PSEUDONYM_LENGTH = 16
 
-    def __init__(self, fields: List[str]):
+    def __init__(self, fields: List[str], pseudonym_key: bytes = None,
+                 cache_size: int = 65536):
         super(RedactingFormatter, self).__init__(self.FORMAT)
+        if pseudonym_key is None:
+            self._token = None
+            self._replacement = _replacement(self.REDACTION, self.SEPARATOR)
+        else:
+            self._token = lru_cache(maxsize=cache_size)(partial(
+                _pseudonym, pseudonym_key, self.PSEUDONYM_LENGTH))
+            self._replacement = self._pseudonymize
+        self.set_fields(fields)
+
+    def _pseudonymize(self, match) -> str:
+        """ substitution replacing a matched value by its token """
+        return '{}={}{}'.format(match.group(1), self._token(match.group(2)),
+                                self.SEPARATOR)
+
+    def set_fields(self, fields: List[str]) -> None:
+        """ swaps the redacted fields of a formatter already in use """
+        self._pattern = _field_pattern(tuple(fields), self.SEPARATOR)
         self.fields = fields
 
+    def reload_fields(self, path: str) -> None:
+        """ replaces the redacted fields with the ones listed in path """
+        self.set_fields(load_fields(path))
+
     def format(self, record: logging.LogRecord) -> str:
         """
         method to filter values in incoming log records using filter_datum
         """
-        return filter_datum(self.fields, self.REDACTION,
-                            super().format(record), self.SEPARATOR)
+        message = super().format(record)
+        if self._pattern is None:
+            return message
+        return self._pattern.sub(self._replacement, message)
+
+
+@lru_cache(maxsize=32)
+def _field_pattern(fields: Tuple[str, ...], separator: str) -> Pattern:
+    """
+    compiles one pattern matching any of the fields, so a message is
+    redacted in a single pass; returns None when there are no fields
+    """
+    if not fields:
+        return None
+    return re.compile(f'({_trie_regex(fields)})=(.*?){re.escape(separator)}')
+
+
+def _trie_regex(fields: Tuple[str, ...]) -> str:
+    """
+    regex matching any of the fields, factored as a prefix trie so the
+    cost of matching a key depends on its length, not on len(fields)
+    """
+    trie = {}
+    for field in fields:
+        node = trie
+        for char in field:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return _trie_node(trie)
+
+
+def _trie_node(node: dict) -> str:
+    """ regex for the suffixes below one trie node """
+    branches = [re.escape(char) + _trie_node(child)
+                for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ''
+    if len(branches) == 1 and '' not in node:
+        return branches[0]
+    return '(?:{}){}'.format('|'.join(branches), '?' if '' in node else '')
+
+
+def load_fields(path: str) -> Tuple[str, ...]:
+    """
+    reads field names from a file, one per line; blank lines and lines
+    starting with # are skipped
+    """
+    with open(path, 'r') as f:
+        lines = (line.strip() for line in f)
+        return tuple(line for line in lines
+                     if line and not line.startswith('#'))
+
+
+def _replacement(redaction: str, separator: str) -> str:
+    """ substitution template keeping the matched field name """
+    return r'\g<1>=' + (redaction + separator).replace('\\', '\\\\')
+
+
+def _pseudonym(key: bytes, length: int, value: str) -> str:
+    """ hex HMAC-SHA256 of value under key, cut to length characters """
+    digest = hmac.new(key, value.encode('utf-8'), hashlib.sha256)
+    return digest.hexdigest()[:length]
+
+
+def _pseudonym_key() -> bytes:
+    """ key from PERSONAL_DATA_PSEUDONYM_KEY, None to redact instead """
+    key = os.getenv('PERSONAL_DATA_PSEUDONYM_KEY')
+    return key.encode('utf-8') if key else None
 
 
 def filter_datum(fields: List[str], redaction: str, message: str,
                  separator: str) -> str:
     """ function that returns the log message obfuscated: """
-    for field in fields:
-        message = re.sub(f'{field}=(.*?){separator}',
-                         f'{field}={redaction}{separator}', message)
-    return message
+    pattern = _field_pattern(tuple(fields), separator)
+    if pattern is None:
+        return message
+    return pattern.sub(_replacement(redaction, separator), message)
+
+
+class JSONRedactingFormatter(RedactingFormatter):
+    """ Formatter writing each record as one compact JSON object
+
+        A record whose message is a dict (a row, as logged by
+        export_users in structured mode) is redacted by key lookup and
+        serialized as-is, without the %-format step; other messages are
+        rendered and regex-redacted like RedactingFormatter does.
+        """
+
+    def __init__(self, fields: List[str], pseudonym_key: bytes = None,
+                 cache_size: int = 65536):
+        super(JSONRedactingFormatter, self).__init__(fields, pseudonym_key,
+                                                     cache_size)
+        self._encoder = json.JSONEncoder(separators=(',', ':'), default=str)
+        self._stamp = (None, None)
+
+    def set_fields(self, fields: List[str]) -> None:
+        """ swaps the redacted fields and keys of a formatter in use """
+        self._keys = frozenset(fields)
+        super(JSONRedactingFormatter, self).set_fields(fields)
+
+    def format(self, record: logging.LogRecord) -> str:
+        """ serializes the record, redacting PII keys or fields """
+        entry = {'logger': record.name, 'level': record.levelname,
+                 'time': self._time(record)}
+        if isinstance(record.msg, dict):
+            keys = self._keys
+            if self._token is None:
+                redaction = self.REDACTION
+                entry['data'] = {key: redaction if key in keys else value
+                                 for key, value in record.msg.items()}
+            else:
+                token = self._token
+                entry['data'] = {key: token(str(value)) if key in keys
+                                 else value
+                                 for key, value in record.msg.items()}
+        else:
+            message = record.getMessage()
+            if self._pattern is not None:
+                message = self._pattern.sub(self._replacement, message)
+            entry['message'] = message
+        return self._encoder.encode(entry)
+
+    def _time(self, record: logging.LogRecord) -> str:
+        """ formatTime, reusing the date part within the same second """
+        second, stamp = self._stamp
+        if int(record.created) != second:
+            stamp = time.strftime(self.default_time_format,
+                                  self.converter(record.created))
+            self._stamp = (int(record.created), stamp)
+        return self.default_msec_format % (stamp, record.msecs)
+
+
+_sinks = {}
+_sinks_lock = threading.RLock()
+_loggers = {}
+
+
+def get_logger(fields: Tuple[str, ...] = None,
+               name: str = 'user_data') -> logging.Logger:
+    """
+    function that returns the logging.Logger object for name, writing
+    to stderr and redacting fields (PII_FIELDS by default). Each logger
+    is configured once and later calls return it without stacking
+    handlers. Another set of fields gets a logger of its own, named
+    `name(field,...)`, so callers never change what another caller's
+    logger redacts; only configure_logger changes a logger in place
+    """
+    fields = tuple(fields or PII_FIELDS)
+    with _sinks_lock:
+        logger = _loggers.get((name, fields))
+        if logger is None:
+            logger_name = name
+            if fields != PII_FIELDS:
+                logger_name = '{}({})'.format(name, ','.join(fields))
+            logger = logging.getLogger(logger_name)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            configure_logger(logger, fields, StreamHandler())
+            _loggers[(name, fields)] = logger
+        return logger
+
+
+def configure_logger(logger: logging.Logger, fields: Tuple[str, ...] = None,
+                     handler: logging.Handler = None,
+                     structured: bool = None) -> logging.Logger:
+    """
+    reconfigures a logger from get_logger in place: fields replaces the
+    redacted fields, handler replaces the sink (every handler of the old
+    chain is closed, outermost first, except those the new one wraps, as
+    AsyncHandler does) and structured switches between text and JSON
+    lines. Unset arguments keep their current value.
+    """
+    with _sinks_lock:
+        current = _sinks.get(logger.name)
+        formatter = _sink_formatter(logger)
+        if fields is None:
+            fields = formatter.fields if formatter else PII_FIELDS
+        if structured is None:
+            structured = isinstance(formatter, JSONRedactingFormatter)
+        sink = current if handler is None else handler
+        chain = _handler_chain(sink)
+        target = chain[-1]
+        if formatter is None or target.formatter is not formatter or \
+                structured != isinstance(formatter, JSONRedactingFormatter):
+            kind = JSONRedactingFormatter if structured \
+                else RedactingFormatter
+            target.setFormatter(kind(fields, _pseudonym_key()))
+        else:
+            formatter.set_fields(fields)
+        if sink is not current:
+            logger.addHandler(sink)
+            _sinks[logger.name] = sink
+            if current is not None:
+                logger.removeHandler(current)
+                for old in _handler_chain(current):
+                    if old not in chain:
+                        old.close()
+        return logger
+
 
+def _handler_chain(handler: logging.Handler) -> List[logging.Handler]:
+    """ handler followed by the targets it forwards records to """
+    chain = [handler]
+    while getattr(chain[-1], 'target', None) is not None:
+        chain.append(chain[-1].target)
+    return chain
 
-def get_logger() -> logging.Logger:
+
+def _flush_logger(logger: logging.Logger) -> None:
+    """
+    writes out every record logger has accepted so far: queues are
+    drained, buffers flushed and compressed files finished and indexed
+    """
+    for handler in logger.handlers:
+        for link in _handler_chain(handler):
+            link.flush()
+            if isinstance(link, CompressedRotatingFileHandler):
+                link.commit()
+
+
+def _sink_formatter(logger: logging.Logger) -> RedactingFormatter:
+    """ formatter of the sink configure_logger attached to logger """
+    sink = _sinks.get(logger.name)
+    if sink is None:
+        return None
+    return _handler_chain(sink)[-1].formatter
+
+
+class AsyncHandler(QueueHandler):
+    """ Handler that only enqueues records on the caller's thread
+
+        A background thread formats them with the target handler's
+        formatter and writes them in batches. When the bounded queue is
+        full, `policy` decides what happens: 'block' waits for room,
+        'drop' discards the record and 'count' discards it but keeps a
+        tally that is reported when the handler is closed.
+        """
+
+    POLICIES = ('block', 'drop', 'count')
+
+    def __init__(self, target: logging.Handler, maxsize: int = 10000,
+                 policy: str = 'block', batch_size: int = 512):
+        if policy not in self.POLICIES:
+            raise ValueError(f'unknown queue policy: {policy}')
+        super(AsyncHandler, self).__init__(queue.Queue(maxsize))
+        self.target = target
+        self.policy = policy
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._monitor,
+                                        name='user_data-log', daemon=True)
+        self._thread.start()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        merges the message arguments so the record can be formatted later;
+        redaction is left to the background thread
+        """
+        record = copy.copy(record)
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        """ puts a record on the queue according to the full-queue policy """
+        if self.policy == 'block':
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.policy == 'count':
+                self.dropped += 1
+
+    def _monitor(self) -> None:
+        """ drains the queue in batches until the stop sentinel arrives """
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            running = self._write(batch)
+            for _ in batch:
+                self.queue.task_done()
+            if not running:
+                return
+
+    def _write(self, batch: List[logging.LogRecord]) -> bool:
+        """
+        formats a batch and writes it with a single call to the target;
+        returns False once the stop sentinel has been seen
+        """
+        target = self.target
+        running = True
+        lines = []
+        for record in batch:
+            if record is None:
+                running = False
+                continue
+            if record.levelno < target.level or not target.filter(record):
+                continue
+            if not isinstance(target, StreamHandler):
+                target.handle(record)
+                continue
+            try:
+                lines.append(target.format(record) + target.terminator)
+            except Exception:
+                target.handleError(record)
+        if lines:
+            with target.lock:
+                try:
+                    target.stream.write(''.join(lines))
+                    target.flush()
+                except Exception:
+                    target.handleError(batch[-1])
+        return running
+
+    def flush(self) -> None:
+        """ waits until every queued record has been written """
+        if self._thread.is_alive():
+            self.queue.join()
+
+    def close(self) -> None:
+        """ reports dropped records, then flushes the queue and stops """
+        if self._thread.is_alive():
+            if self.dropped:
+                self.queue.put(logging.makeLogRecord({
+                    'name': 'user_data', 'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': f'{self.dropped} records dropped: queue full'}))
+                self.dropped = 0
+            self.queue.put(None)
+            self._thread.join()
+        super(AsyncHandler, self).close()
+
+
+def get_json_logger() -> logging.Logger:
     """
-    function that takes no arguments and returns a logging.Logger object
+    same as get_logger, but records are written as JSON lines by a
+    JSONRedactingFormatter
     """
-    logger = logging.getLogger('user_data')
-    logger.setLevel(logging.INFO)
-    logger.propagate = False
+    return configure_logger(get_logger(), structured=True)
 
-    handler = StreamHandler()
-    formatter = RedactingFormatter(PII_FIELDS)
-    handler.setFormatter(formatter)
 
-    logger.addHandler(handler)
+def get_async_logger(maxsize: int = 10000,
+                     policy: str = 'block') -> logging.Logger:
+    """
+    same as get_logger, but redaction and writes happen on a background
+    thread; records still queued are flushed at interpreter shutdown
+    """
+    logger = get_logger()
+    if not isinstance(_sinks[logger.name], AsyncHandler):
+        configure_logger(logger, handler=AsyncHandler(
+            _sinks[logger.name], maxsize, policy))
     return logger
 
 
-def get_db() -> mysql.connector.connection.MYSQLConnection:
+class RateLimitingHandler(logging.Handler):
+    """ Handler sampling and rate-limiting records before target sees them
+
+        A record is first kept with probability `sample`, then needs a
+        token from the bucket of its (logger, level), refilled at `rate`
+        tokens per second up to `burst` (a rate of None only samples).
+        Dropped records never reach the target, so they are not
+        formatted or redacted; how many were dropped per (logger, level)
+        is sent to the target as a warning every report_interval seconds
+        by a background thread, whether or not more records arrive, and
+        on close.
+        """
+
+    def __init__(self, target: logging.Handler,
+                 rate: Optional[float] = 100.0,
+                 burst: int = 200, sample: float = 1.0,
+                 report_interval: float = 60.0):
+        super(RateLimitingHandler, self).__init__()
+        self.target = target
+        self.rate = rate
+        self.burst = burst
+        self.sample = sample
+        self.report_interval = report_interval
+        self._buckets = {}
+        self._suppressed = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._reporter,
+                                        name='user_data-report', daemon=True)
+        self._thread.start()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        """ forwards the record to target if sampling and rate allow """
+        now = time.monotonic()
+        key = (record.name, record.levelno)
+        if self.sample < 1.0 and random.random() >= self.sample:
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+        elif self.rate is None:
+            self.target.handle(record)
+        else:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                self.target.handle(record)
+            else:
+                self._buckets[key] = (tokens, now)
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+
+    def _reporter(self) -> None:
+        """ reports suppressed records every report_interval until closed """
+        while not self._stopped.wait(self.report_interval):
+            with self.lock:
+                if self._suppressed:
+                    self._report()
+
+    def _report(self) -> None:
+        """ tells target how many records were dropped since last time """
+        for (name, levelno), count in self._suppressed.items():
+            self.target.handle(logging.makeLogRecord({
+                'name': name, 'levelno': logging.WARNING,
+                'levelname': 'WARNING',
+                'msg': '{} {} records suppressed'.format(
+                    count, logging.getLevelName(levelno))}))
+        self._suppressed = {}
+
+    def close(self) -> None:
+        """
+        reports what is still unreported; target is left open, as it
+        may be reused (configure_logger closes the rest of a chain)
+        """
+        self._stopped.set()
+        with self.lock:
+            self._report()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        super(RateLimitingHandler, self).close()
+
+
+def get_rate_limited_logger(rate: Optional[float] = 100.0, burst: int = 200,
+                            sample: float = 1.0) -> logging.Logger:
+    """
+    same as get_logger, with a RateLimitingHandler in front of the
+    current sink
+    """
+    logger = get_logger()
+    sink = _sinks[logger.name]
+    if isinstance(sink, RateLimitingHandler):
+        sink.rate, sink.burst, sink.sample = rate, burst, sample
+        return logger
+    return configure_logger(logger, handler=RateLimitingHandler(
+        sink, rate, burst, sample))
+
+
+class CompressedRotatingFileHandler(logging.Handler):
+    """ Handler writing gzip-compressed files that rotate by size or count
+
+        Records are buffered and compressed in blocks of buffer_size
+        bytes into `<base>.<n>.gz`, a new file being started after
+        max_bytes of uncompressed output or max_records records (0 turns
+        a limit off). `<base>.index` holds a JSON line per file with its
+        name and the numbers of the first and last records it holds,
+        which read_records uses to decompress only the files covering a
+        slice. commit ends the current gzip member and updates the entry
+        of the file, which later records keep growing. Numbering carries
+        on from an existing index and skips any file already on disk,
+        such as one left unindexed by an unclean exit, which is never
+        overwritten.
+        """
+
+    def __init__(self, base: str, max_bytes: int = 64 << 20,
+                 max_records: int = 0, buffer_size: int = 1 << 20,
+                 compresslevel: int = 6):
+        super(CompressedRotatingFileHandler, self).__init__()
+        self.base = base
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.buffer_size = buffer_size
+        self.compresslevel = compresslevel
+        self._raw = None
+        self._file = None
+        self._buffer = []
+        self._buffered = 0
+        self._entries = read_index(base)
+        self._file_number, self._next_record = 0, 0
+        if self._entries:
+            self._file_number = self._entries[-1]['number'] + 1
+            self._next_record = self._entries[-1]['last'] + 1
+
+    def emit(self, record: logging.LogRecord) -> None:
+        """ buffers one formatted record, rotating when a limit is hit """
+        try:
+            line = (self.format(record) + '\n').encode('utf-8')
+            if self._raw is None:
+                self._open()
+            if self._file is None:
+                self._file = gzip.GzipFile(fileobj=self._raw, mode='wb',
+                                           compresslevel=self.compresslevel)
+            self._buffer.append(line)
+            self._buffered += len(line)
+            self._bytes += len(line)
+            self._records += 1
+            if self._buffered >= self.buffer_size:
+                self._write_buffer()
+            if (self.max_bytes and self._bytes >= self.max_bytes) or \
+                    (self.max_records and self._records >= self.max_records):
+                self._rotate()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self) -> None:
+        """ hands the buffered records to the compressor """
+        with self.lock:
+            if self._file is not None:
+                self._write_buffer()
+
+    def close(self) -> None:
+        """ finishes the current file and records it in the index """
+        with self.lock:
+            if self._raw is not None:
+                self._rotate()
+        super(CompressedRotatingFileHandler, self).close()
+
+    def commit(self) -> None:
+        """
+        ends the current gzip member and indexes it, so every record
+        emitted so far is complete on disk and listed in the index; the
+        file stays open for the next member
+        """
+        with self.lock:
+            if self._file is not None:
+                self._end_member()
+                self._raw.flush()
+                self._write_index()
+
+    def _open(self) -> None:
+        """ starts the next numbered file that does not exist yet """
+        while True:
+            self._name = '{}.{:05d}.gz'.format(self.base, self._file_number)
+            try:
+                self._raw = open(self._name, 'xb')
+                break
+            except FileExistsError:
+                self._file_number += 1
+        self._bytes = 0
+        self._records = 0
+
+    def _write_buffer(self) -> None:
+        """ compresses the buffered block """
+        if self._buffer:
+            self._file.write(b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def _end_member(self) -> None:
+        """ compresses the buffer and writes the gzip trailer """
+        self._write_buffer()
+        self._file.close()
+        self._file = None
+
+    def _write_index(self) -> None:
+        """ replaces the index with one that lists the current file """
+        entry = {'number': self._file_number,
+                 'file': os.path.basename(self._name),
+                 'first': self._next_record,
+                 'last': self._next_record + self._records - 1,
+                 'bytes': self._bytes}
+        if self._entries and \
+                self._entries[-1]['number'] == self._file_number:
+            self._entries[-1] = entry
+        else:
+            self._entries.append(entry)
+        tmp_path = self.base + '.index.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(''.join(json.dumps(e) + '\n' for e in self._entries))
+        os.replace(tmp_path, self.base + '.index')
+
+    def _rotate(self) -> None:
+        """ closes the current file and indexes it """
+        if self._file is not None:
+            self._end_member()
+        self._raw.close()
+        self._raw = None
+        if self._records:
+            self._write_index()
+        self._file_number += 1
+        self._next_record += self._records
+
+
+def read_index(base: str) -> List[dict]:
+    """ entries of the index written by CompressedRotatingFileHandler """
+    if not os.path.exists(base + '.index'):
+        return []
+    with open(base + '.index', 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def read_records(base: str, first: int, last: int) -> Iterator[str]:
+    """
+    yields records first to last (inclusive) of a compressed log,
+    opening only the files whose range overlaps the slice and reading
+    no further than their indexed records
+    """
+    directory = os.path.dirname(base)
+    for entry in read_index(base):
+        if entry['last'] < first or entry['first'] > last:
+            continue
+        end = min(last, entry['last'])
+        with gzip.open(os.path.join(directory, entry['file']), 'rt',
+                       encoding='utf-8') as f:
+            for number, line in enumerate(f, entry['first']):
+                if number >= first:
+                    yield line.rstrip('\n')
+                if number >= end:
+                    break
+
+
+def get_file_logger(base: str, structured: bool = False,
+                    max_bytes: int = 64 << 20,
+                    max_records: int = 0) -> logging.Logger:
+    """
+    same as get_logger (or get_json_logger when structured), but
+    records go to a CompressedRotatingFileHandler; an existing sink
+    writing to base is kept
+    """
+    logger = get_logger()
+    sink = _handler_chain(_sinks[logger.name])[-1]
+    if isinstance(sink, CompressedRotatingFileHandler) and sink.base == base:
+        return configure_logger(logger, structured=structured)
+    handler = CompressedRotatingFileHandler(base, max_bytes, max_records)
+    return configure_logger(logger, handler=handler, structured=structured)
+
+
+def get_db() -> mysql.connector.connection.MySQLConnection:
     """ MySQL environment connection"""
     db_connect = mysql.connector.connect(
         user=os.getenv('PERSONAL_DATA_DB_USERNAME', 'root'),
@@ -68,25 +713,413 @@ def get_db() -> mysql.connector.connection.MYSQLConnection:
     return db_connect
 
 
-def main() -> None:
+class ConnectionPool:
+    """ Bounded pool of database connections
+
+        Connections are opened lazily with `connect` (get_db by default)
+        up to `size` at a time; acquire() waits at most `timeout` seconds
+        for one to be returned. Idle connections are checked before they
+        are handed out again and replaced when they went stale.
+        """
+
+    def __init__(self, size: int = 5, timeout: float = 30.0,
+                 connect: Callable = None):
+        self.size = size
+        self.timeout = timeout
+        self._connect = connect
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self):
+        """ returns a live connection, opening one if none is idle """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise mysql.connector.errors.PoolError(
+                f'no connection available after {self.timeout}s')
+        try:
+            while True:
+                try:
+                    db = self._idle.get_nowait()
+                except queue.Empty:
+                    return (self._connect or get_db)()
+                if self._is_alive(db):
+                    return db
+                self._discard(db)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, db) -> None:
+        """ hands a connection back, rolling back any open transaction """
+        try:
+            if getattr(db, 'in_transaction', False):
+                db.rollback()
+            self._idle.put(db)
+        except Exception:
+            self._discard(db)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator:
+        """ context manager lending a connection for the with block """
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def close(self) -> None:
+        """ closes every idle connection """
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+    @staticmethod
+    def _is_alive(db) -> bool:
+        """ pings the server through the connection """
+        try:
+            return db.is_connected()
+        except Exception:
+            return False
+
+    @staticmethod
+    def _discard(db) -> None:
+        """ closes a connection, ignoring errors from a dead socket """
+        try:
+            db.close()
+        except Exception:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_db_pool() -> ConnectionPool:
     """
-    Establish database connection using get_db
+    process-wide connection pool sized by PERSONAL_DATA_DB_POOL_SIZE
+    and PERSONAL_DATA_DB_POOL_TIMEOUT
     """
-    db = get_db()
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                int(os.getenv('PERSONAL_DATA_DB_POOL_SIZE', '5')),
+                float(os.getenv('PERSONAL_DATA_DB_POOL_TIMEOUT', '30')))
+        return _pool
+
+
+@contextmanager
+def pooled_db() -> Iterator:
+    """ pooled variant of get_db, returning the connection on exit """
+    with get_db_pool().connection() as db:
+        yield db
+
+
+def _row_template(headers: List[str]) -> str:
+    """
+    builds a format string rendering a row as `header=value; ` pairs
+    """
+    return ''.join('{}={{}}; '.format(h.replace('{', '{{').replace('}', '}}'))
+                   for h in headers)
+
+
+def _row_renderer(headers: List[str],
+                  structured: bool = False) -> Callable[[tuple], Any]:
+    """
+    returns the function turning a row into the message to log: a
+    `header=value; ` string, or a dict when structured is set
+    """
+    if structured:
+        headers = tuple(headers)
+        return lambda row: dict(zip(headers, row))
+    return lambda row, template=_row_template(headers): template.format(*row)
+
+
+def export_users(db: mysql.connector.connection.MySQLConnection,
+                 logger: logging.Logger, batch_size: int = 1000,
+                 structured: bool = False,
+                 columns: str = '*') -> Tuple[int, float]:
+    """
+    streams the users table through logger, fetching batch_size rows
+    at a time from an unbuffered cursor so memory use stays constant;
+    structured logs each row as a dict for JSONRedactingFormatter and
+    columns is the select list (see masked_columns).
+    returns the number of rows exported and the seconds it took
+    """
+    start = time.perf_counter()
+    cursor = db.cursor(buffered=False)
+    count = 0
+    try:
+        cursor.execute(f"SELECT {columns} FROM users;")
+        render = _row_renderer([field[0] for field in cursor.description],
+                               structured)
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            for row in rows:
+                logger.info(render(row))
+            count += len(rows)
+            rows = cursor.fetchmany(batch_size)
+    finally:
+        cursor.close()
+    return count, time.perf_counter() - start
+
+
+@lru_cache(maxsize=None)
+def _chunk_formatter(fields: Tuple[str, ...],
+                     structured: bool) -> RedactingFormatter:
+    """ one formatter per worker process, field set and output mode """
+    if structured:
+        return JSONRedactingFormatter(fields, _pseudonym_key())
+    return RedactingFormatter(fields, _pseudonym_key())
+
+
+def _redact_chunk(fields: Tuple[str, ...], headers: Tuple[str, ...],
+                  rows: List[tuple], structured: bool = False) -> str:
+    """
+    worker side of export_users_parallel: renders a chunk of rows as
+    the lines the user_data logger would have written for them
+    """
+    formatter = _chunk_formatter(fields, structured)
+    render = _row_renderer(headers, structured)
+    lines = []
+    for row in rows:
+        record = logging.LogRecord('user_data', logging.INFO, __file__, 0,
+                                   render(row), None, None)
+        lines.append(formatter.format(record) + '\n')
+    return ''.join(lines)
+
+
+def export_users_parallel(db: mysql.connector.connection.MySQLConnection,
+                          workers: int, batch_size: int = 1000,
+                          stream=None, structured: bool = False,
+                          columns: str = '*') -> Tuple[int, float]:
+    """
+    same output as export_users, but chunks of batch_size rows are
+    redacted in a pool of worker processes; chunks are written to
+    stream (stderr by default) in their original order and at most
+    two chunks per worker are in flight at any time
+    """
+    stream = sys.stderr if stream is None else stream
+    start = time.perf_counter()
+    cursor = db.cursor(buffered=False)
+    count = 0
+    try:
+        cursor.execute(f"SELECT {columns} FROM users;")
+        headers = tuple(field[0] for field in cursor.description)
+        with ProcessPoolExecutor(workers) as pool:
+            pending = deque()
+            rows = cursor.fetchmany(batch_size)
+            while rows:
+                pending.append(pool.submit(_redact_chunk, PII_FIELDS,
+                                           headers, rows, structured))
+                count += len(rows)
+                if len(pending) >= 2 * workers:
+                    stream.write(pending.popleft().result())
+                rows = cursor.fetchmany(batch_size)
+            while pending:
+                stream.write(pending.popleft().result())
+        stream.flush()
+    finally:
+        cursor.close()
+    return count, time.perf_counter() - start
+
+
+def _primary_key(db: mysql.connector.connection.MySQLConnection,
+                 table: str = 'users') -> Tuple[str, ...]:
+    """ column names of the primary key of table, in index order """
     cursor = db.cursor()
-    cursor.execute("SELECT * FROM users;")
+    try:
+        cursor.execute(f"SHOW KEYS FROM `{table}` WHERE Key_name = 'PRIMARY';")
+        names = [field[0] for field in cursor.description]
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    seq, column = names.index('Seq_in_index'), names.index('Column_name')
+    return tuple(row[column] for row in sorted(rows, key=lambda r: r[seq]))
 
-    headers = [field[0] for field in cursor.description]
-    logger = get_logger()
 
-    for row in cursor:
-        info_answer = ''
-        for f, p in zip(row, headers):
-            info_answer += f'{p}={(f)}; '
-        logger.info(info_answer)
+def _read_checkpoint(path: str) -> dict:
+    """ last saved export position, or None when starting afresh """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _write_checkpoint(path: str, state: dict) -> None:
+    """ atomically replaces the checkpoint file """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, default=str)
+    os.replace(tmp_path, path)
+
 
-    cursor.close()
-    db.close()
+def export_users_resumable(db: mysql.connector.connection.MySQLConnection,
+                           logger: logging.Logger, checkpoint: str,
+                           page_size: int = 1000, structured: bool = False,
+                           key: Tuple[str, ...] = None,
+                           columns: str = '*') -> Tuple[int, float]:
+    """
+    exports the users table page by page in primary key order,
+    seeking past the last key seen (never OFFSET) so every page costs
+    the same. After each page the logger's handlers are flushed (a
+    compressed file sink finishes its file) and only then is the last
+    key saved to checkpoint, which a later call resumes from; rows of a
+    page interrupted before its checkpoint was written are exported
+    again. The checkpoint is removed once the table is done.
+    returns the rows exported by this call and the seconds it took
+    """
+    start = time.perf_counter()
+    key = tuple(key or _primary_key(db))
+    if not key:
+        raise ValueError('users has no primary key to paginate on')
+    order = ', '.join(f'`{column}`' for column in key)
+    after = f'`{key[0]}` > %s' if len(key) == 1 else \
+        '({}) > ({})'.format(order, ', '.join(['%s'] * len(key)))
+    first_page = f"SELECT {columns} FROM users ORDER BY {order} LIMIT %s;"
+    next_page = f"SELECT {columns} FROM users WHERE {after} " \
+        f"ORDER BY {order} LIMIT %s;"
+
+    state = _read_checkpoint(checkpoint) or {'key': None, 'rows': 0}
+    count = 0
+    render = None
+    while True:
+        cursor = db.cursor()
+        try:
+            if state['key'] is None:
+                cursor.execute(first_page, (page_size,))
+            else:
+                cursor.execute(next_page, (*state['key'], page_size))
+            rows = cursor.fetchall()
+            if render is None:
+                headers = [field[0] for field in cursor.description]
+                render = _row_renderer(headers, structured)
+                positions = [headers.index(column) for column in key]
+        finally:
+            cursor.close()
+        if not rows:
+            break
+        for row in rows:
+            logger.info(render(row))
+        count += len(rows)
+        state = {'key': [rows[-1][i] for i in positions],
+                 'rows': state['rows'] + len(rows)}
+        _flush_logger(logger)
+        _write_checkpoint(checkpoint, state)
+        if len(rows) < page_size:
+            break
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return count, time.perf_counter() - start
+
+
+def masked_columns(db: mysql.connector.connection.MySQLConnection,
+                   fields: Tuple[str, ...] = PII_FIELDS,
+                   structured: bool = False,
+                   keep: Tuple[str, ...] = ()) -> str:
+    """
+    select list for users that sends a constant REDACTION instead of
+    every column the formatter would redact, so PII never leaves the
+    server. In text mode that is every column whose `name=` the field
+    pattern matches (the name ends with a field); in structured mode
+    only exact field names, as JSONRedactingFormatter does. Lines stay
+    identical to regex redaction unless a PII value holds SEPARATOR.
+    Columns in keep, such as a pagination key, are always selected.
+    """
+    cursor = db.cursor()
+    try:
+        cursor.execute("SELECT * FROM users LIMIT 0;")
+        names = [field[0] for field in cursor.description]
+        cursor.fetchall()
+    finally:
+        cursor.close()
+    redaction = RedactingFormatter.REDACTION.replace("'", "''")
+    select = []
+    for name in names:
+        if name in keep:
+            select.append(f'`{name}`')
+        elif name in fields or not structured and name.endswith(fields):
+            select.append(f"'{redaction}' AS `{name}`")
+        else:
+            select.append(f'`{name}`')
+    return ', '.join(select)
+
+
+def report_export(count: int, elapsed: float) -> None:
+    """ writes the export throughput to stderr """
+    rate = count / elapsed if elapsed > 0 else float(count)
+    print('exported {} rows in {:.2f}s ({:.0f} rows/sec)'.format(
+        count, elapsed, rate), file=sys.stderr)
+
+
+def _export_logger(structured: bool) -> logging.Logger:
+    """
+    logger for main: a rotating compressed file when
+    PERSONAL_DATA_LOG_FILE is set, stderr otherwise, rate-limited to
+    PERSONAL_DATA_LOG_RATE records/sec and sampled at
+    PERSONAL_DATA_LOG_SAMPLE when those are set
+    """
+    base = os.getenv('PERSONAL_DATA_LOG_FILE')
+    if base:
+        logger = get_file_logger(
+            base, structured,
+            int(os.getenv('PERSONAL_DATA_LOG_MAX_BYTES', str(64 << 20))),
+            int(os.getenv('PERSONAL_DATA_LOG_MAX_RECORDS', '0')))
+    else:
+        logger = configure_logger(get_logger(), structured=structured)
+    rate = os.getenv('PERSONAL_DATA_LOG_RATE')
+    sample = os.getenv('PERSONAL_DATA_LOG_SAMPLE')
+    if rate or sample:
+        rate = float(rate) if rate else None
+        logger = get_rate_limited_logger(rate, int(rate or 0) or 1,
+                                         float(sample or '1'))
+    return logger
+
+
+def main() -> None:
+    """
+    Establish database connection using get_db
+    """
+    batch_size = int(os.getenv('PERSONAL_DATA_EXPORT_BATCH_SIZE', '1000'))
+    workers = int(os.getenv('PERSONAL_DATA_EXPORT_WORKERS', '1'))
+    structured = os.getenv('PERSONAL_DATA_EXPORT_FORMAT') == 'json'
+    checkpoint = os.getenv('PERSONAL_DATA_EXPORT_CHECKPOINT')
+    if workers > 1 and not checkpoint:
+        for name in ('PERSONAL_DATA_LOG_FILE', 'PERSONAL_DATA_LOG_RATE',
+                     'PERSONAL_DATA_LOG_SAMPLE'):
+            if os.getenv(name):
+                raise ValueError(f'{name} is not supported with '
+                                 'PERSONAL_DATA_EXPORT_WORKERS > 1')
+    db = get_db()
+    key = os.getenv('PERSONAL_DATA_EXPORT_KEY')
+    try:
+        key = tuple(key.split(',')) if key else ()
+        if checkpoint and not key:
+            key = _primary_key(db)
+        columns = '*'
+        if os.getenv('PERSONAL_DATA_EXPORT_MASK_IN_SQL') and \
+                _pseudonym_key() is None:
+            columns = masked_columns(db, PII_FIELDS, structured, key)
+        if checkpoint:
+            logger = _export_logger(structured)
+            count, elapsed = export_users_resumable(
+                db, logger, checkpoint, batch_size, structured, key,
+                columns=columns)
+        elif workers > 1:
+            count, elapsed = export_users_parallel(
+                db, workers, batch_size, structured=structured,
+                columns=columns)
+        else:
+            logger = _export_logger(structured)
+            count, elapsed = export_users(db, logger, batch_size,
+                                          structured, columns)
+    finally:
+        db.close()
+    if os.getenv('PERSONAL_DATA_EXPORT_STATS'):
+        report_export(count, elapsed)
 
 
 if __name__ == '__main__':
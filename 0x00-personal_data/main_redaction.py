@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+""" Main redaction
+
+Compares filter_datum with the original per-field re.sub loop on random
+messages: keys, prefixes of keys and values are drawn from small pools,
+so fields overlap and occur anywhere in a key.
+
+    ./main_redaction.py [MESSAGES]
+"""
+import random
+import re
+import sys
+from filtered_logger import filter_datum
+
+
+def reference(fields, redaction, message, separator):
+    """ filter_datum as first written, one substitution per field """
+    for field in fields:
+        message = re.sub(f'{field}=(.*?){separator}',
+                         f'{field}={redaction}{separator}', message)
+    return message
+
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+pool = ['name', 'email', 'password', 'ssn', 'phone',
+        'e', 'em', 'pass', 'na', 'user_name', 'x']
+rand = random.Random(0)
+mismatches = 0
+for _ in range(count):
+    fields = rand.sample(pool, rand.randint(0, 5))
+    parts = []
+    for _ in range(rand.randint(0, 6)):
+        key = rand.choice(pool) + rand.choice(['', '', 'x'])
+        value = ''.join(rand.choice('ab1 @.')
+                        for _ in range(rand.randint(0, 6)))
+        parts.append('{}={};'.format(key, value))
+    message = ''.join(parts) + rand.choice(['', 'tail', 'name=open'])
+    if filter_datum(fields, '***', message, ';') != \
+            reference(fields, '***', message, ';'):
+        mismatches += 1
+        if mismatches <= 3:
+            print("mismatch: {} {!r}".format(fields, message))
+print("{} messages, {} mismatches".format(count, mismatches))
+sys.exit(1 if mismatches else 0)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+""" Main locking
+
+Readers search, list, count and get users while writers change emails,
+remove users and compact the journal, in a scratch directory. Then the
+email index must match the objects, and loading the files again must
+give back what is in memory.
+
+    ./main_locking.py [write-behind]
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+from models.base import INDEXES, _index_ids
+from models.user import User
+
+os.chdir(tempfile.mkdtemp())
+if 'write-behind' in sys.argv[1:]:
+    User.enable_write_behind(5)
+User.load_from_file()
+users = []
+for i in range(200):
+    user = User(email='u{}@x'.format(i % 50))
+    user.save()
+    users.append(user)
+errors = []
+stop = threading.Event()
+
+
+def reader(seed):
+    """ Lookups until the writers are done """
+    rand = random.Random(seed)
+    while not stop.is_set():
+        try:
+            email = 'u{}@x'.format(rand.randrange(50))
+            for user in User.search({'email': email}):
+                assert user.email is not None, user.id
+            User.all()
+            User.count()
+            User.get(rand.choice(users).id)
+        except Exception as e:
+            errors.append(repr(e))
+
+
+def writer(seed):
+    """ Random changes """
+    rand = random.Random(seed)
+    for i in range(1500):
+        try:
+            user = rand.choice(users)
+            op = rand.random()
+            if op < 0.6:
+                user.email = 'u{}@x'.format(rand.randrange(50))
+                user.save()
+            elif op < 0.8:
+                user.remove()
+            elif op < 0.95:
+                user.first_name = str(i)
+                user.save()
+            else:
+                User.save_to_file()
+        except Exception as e:
+            errors.append(repr(e))
+
+
+readers = [threading.Thread(target=reader, args=(n,)) for n in range(4)]
+writers = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+for thread in readers + writers:
+    thread.start()
+for thread in writers:
+    thread.join()
+stop.set()
+for thread in readers:
+    thread.join()
+User.flush()
+print("errors: {} {}".format(len(errors), errors[:3]))
+
+index = INDEXES['User']['email']
+for user in User.all():
+    assert user.id in _index_ids(index, user.email), user.id
+indexed = sum(len(_index_ids(index, value)) for value in index)
+assert indexed == User.count(), (indexed, User.count())
+memory = {user.id: user.to_json(True) for user in User.all()}
+User.load_from_file()
+disk = {user.id: user.to_json(True) for user in User.all()}
+print("users: {}, files match memory: {}".format(len(memory), memory == disk))
+sys.exit(1 if errors or memory != disk else 0)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+""" Main shared
+
+Four processes share the files of a scratch directory, as gunicorn
+workers do: each creates, changes and removes its own users, checks it
+reads its own writes, and compacts often. A fresh load must then hold
+exactly the users the processes kept.
+
+    ./main_shared.py [write-behind]
+"""
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+
+WORKERS = 4
+ROUNDS = 300
+
+
+def worker(n, results):
+    """ Random changes to the users of process n """
+    import models.base
+    from models.user import User
+    models.base.JOURNAL_COMPACT_MIN = 30
+    User.enable_sharing(0)
+    if 'write-behind' in sys.argv[1:]:
+        User.enable_write_behind(5)
+    User.load_from_file()
+    rand = random.Random(n)
+    mine = []
+    errors = []
+    for i in range(ROUNDS):
+        try:
+            op = rand.random()
+            if op < 0.5 or not mine:
+                user = User(email='p{}-{}@x'.format(n, i))
+                user.save()
+                mine.append(user.id)
+            elif op < 0.7:
+                user = User.get(rand.choice(mine))
+                user.first_name = 'n{}'.format(i)
+                user.save()
+            elif op < 0.8:
+                User.get(mine.pop(rand.randrange(len(mine)))).remove()
+            for user_id in mine[-3:]:
+                assert User.get(user_id) is not None, 'lost ' + user_id
+            User.search({'email': 'p0-1@x'})
+        except Exception as e:
+            errors.append(repr(e))
+    User.flush()
+    results.put((n, errors, mine))
+
+
+if __name__ == '__main__':
+    os.chdir(tempfile.mkdtemp())
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(n, results))
+                 for n in range(WORKERS)]
+    for process in processes:
+        process.start()
+    done = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    errors = [e for _, process_errors, _ in done for e in process_errors]
+    expected = sorted(i for _, _, mine in done for i in mine)
+
+    from models.user import User
+    User.enable_sharing(0)
+    User.load_from_file()
+    found = sorted(user.id for user in User.all())
+    print("errors: {} {}".format(len(errors), errors[:3]))
+    print("users: {}, expected: {}, match: {}".format(
+        len(found), len(expected), found == expected))
+    sys.exit(1 if errors or found != expected else 0)
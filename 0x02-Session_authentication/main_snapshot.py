@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+""" Main snapshot
+
+Round trip of a snapshot between the JSON and binary formats, in a
+scratch directory: users whose values exercise every tag of
+models.binary_snapshot are saved as JSON, converted to binary and back,
+and loaded from the binary file. Every step must give back the same
+JSON.
+
+    ./main_snapshot.py
+"""
+import json
+import os
+import sys
+import tempfile
+import models.base
+from models.binary_snapshot import convert
+from models.user import User
+
+VALUES = [None, True, False, 0, -1, 1 << 62, 1 << 70, 0.5, -1e300,
+          '', 'plain', 'héllo wörld', 'lone \ud800 surrogate',
+          '2020-01-02T03:04:05',
+          '2020-13-45T00:00:00', '0123456789abcdef', '0123456789ABCDEF',
+          'abc', '3f2b8e9c-1d4a-4b5e-9f6a-7c8d9e0f1a2b', [1, 'a', None],
+          {'nested': [1.5, {}]}]
+
+os.chdir(tempfile.mkdtemp())
+User.load_from_file()
+for i, value in enumerate(VALUES):
+    user = User(email='u{}@x'.format(i))
+    user.first_name = value
+    user.last_name = VALUES[-1 - i]
+    user.save()
+same_id = User(email='same@x')
+same_id.first_name = same_id.id
+same_id.save()
+User.save_to_file()
+with open('.db_User.json') as f:
+    expected = json.load(f)
+
+convert('.db_User.json', 'converted.bin', User.INDEXED_ATTRIBUTES)
+convert('converted.bin', 'converted.json')
+with open('converted.json') as f:
+    back = json.load(f)
+print("JSON -> binary -> JSON: {}".format(back == expected))
+
+models.base.Base.use_snapshot_format('binary')
+os.replace('converted.bin', '.db_User.bin')
+os.remove('.db_User.json')
+User.load_from_file()
+loaded = {user.id: user.to_json(True) for user in User.all()}
+print("binary load: {}".format(loaded == expected))
+found = User.search({'email': 'u3@x'})
+indexed = len(found) == 1 and found[0].first_name == VALUES[3]
+print("index: {}".format(indexed))
+sys.exit(0 if back == expected == loaded and indexed else 1)
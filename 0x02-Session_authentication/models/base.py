@@ -1,21 +1,470 @@
 #!/usr/bin/env python3
 """ Base module
 """
+from contextlib import contextmanager
 from datetime import datetime
-from typing import TypeVar, List, Iterable
+from typing import TypeVar, List, Iterable, Iterator, Optional, Tuple
 from os import path
+import atexit
+import fcntl
 import json
+import logging
+import os
+import re
+import threading
+import time
 import uuid
+from models.binary_snapshot import PackedSnapshot, write_packed
 
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
 DATA = {}
+INDEXES = {}
+JOURNAL_ENTRIES = {}
+JOURNAL_COMPACT_MIN = 1000
+COMPACT_RETRY = 30
+WRITE_BEHIND = None
+LOADING = {}
+LOAD_ERRORS = {}
+LOCKS = {}
+SHARED_SYNC = None
+STORAGE = None
+SNAPSHOT_FORMAT = 'json'
+SYNC_STATE = {}
+_COMPACT_AFTER = {}
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_FIELDS = {}
+_TIMESTAMPS = {}
+TIMESTAMP_CACHE_SIZE = 65536
+
+
+def parse_timestamp(text: str) -> datetime:
+    """ datetime.strptime(text, TIMESTAMP_FORMAT), without the generic
+    format parser when text has the exact shape TIMESTAMP_FORMAT produces.
+    A datetime, as binary snapshots decode to, is returned as it is
+    """
+    if type(text) is datetime:
+        return text
+    if type(text) is str and len(text) == 19 and text[4] == '-' \
+            and text[7] == '-' and text[10] == 'T' and text[13] == ':' \
+            and text[16] == ':' and text.isascii():
+        try:
+            return datetime.fromisoformat(text)
+        except ValueError:
+            pass
+    return datetime.strptime(text, TIMESTAMP_FORMAT)
+
+
+def format_timestamp(value: datetime) -> str:
+    """ value.strftime(TIMESTAMP_FORMAT), memoized for naive datetimes
+    """
+    text = _TIMESTAMPS.get(value)
+    if text is None:
+        if value.tzinfo is not None or value.year < 1000:
+            # strftime does not pad years below 1000
+            return value.strftime(TIMESTAMP_FORMAT)
+        text = '%04d-%02d-%02dT%02d:%02d:%02d' % (
+            value.year, value.month, value.day,
+            value.hour, value.minute, value.second)
+        if len(_TIMESTAMPS) >= TIMESTAMP_CACHE_SIZE:
+            _TIMESTAMPS.clear()
+        _TIMESTAMPS[value] = text
+    return text
+
+
+def _index_add(index: dict, value, obj_id: str) -> None:
+    """ Record obj_id under value: the bare id while it is the only one,
+    a dict of ids once there are several
+    """
+    try:
+        ids = index.get(value)
+        if ids is None:
+            index[value] = obj_id
+        elif type(ids) is dict:
+            ids[obj_id] = None
+        elif ids != obj_id:
+            index[value] = {ids: None, obj_id: None}
+    except TypeError:
+        pass
+
+
+def _index_remove(index: dict, value, obj_id: str) -> None:
+    """ Forget obj_id under value
+    """
+    try:
+        ids = index.get(value)
+    except TypeError:
+        return
+    if type(ids) is dict:
+        ids.pop(obj_id, None)
+        if len(ids) == 1:
+            index[value] = next(iter(ids))
+    elif ids is not None and ids == obj_id:
+        del index[value]
+
+
+def _index_all(index: dict, values: List, ids: List[str]) -> None:
+    """ _index_add of every (value, id) pair, in one step while values are
+    unique
+    """
+    if not index:
+        try:
+            unique = dict(zip(values, ids))
+        except TypeError:
+            unique = None
+        if unique is not None and len(unique) == len(ids):
+            index.update(unique)
+            return
+    for value, obj_id in zip(values, ids):
+        _index_add(index, value, obj_id)
+
+
+def _index_ids(index: dict, value) -> Iterable[str]:
+    """ Ids recorded under value
+    """
+    ids = index.get(value, ())
+    return ids if type(ids) in (dict, tuple) else (ids,)
+
+
+def _file_id(file_path: str) -> Optional[Tuple[int, int, int]]:
+    """ (inode, mtime, size) of a file, None if it does not exist
+    """
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def iter_snapshot(file_path: str,
+                  chunk_size: int = 1 << 16) -> Iterator[Tuple[str, dict]]:
+    """ Yield the (id, object) pairs of a snapshot file, reading and
+    parsing it chunk by chunk instead of all at once
+    """
+    decoder = json.JSONDecoder()
+    with open(file_path, 'r') as f:
+        buf, pos, eof = '', 0, False
+        expect = '{'
+        while True:
+            try:
+                pos = _WHITESPACE.match(buf, pos).end()
+                if buf[pos] == expect == '{':
+                    pos, expect = pos + 1, 'first'
+                elif buf[pos] == '}' and expect in ('first', ','):
+                    return
+                elif buf[pos] == ',' and expect == ',':
+                    pos, expect = pos + 1, 'key'
+                elif expect in ('first', 'key'):
+                    key, end = decoder.raw_decode(buf, pos)
+                    end = _WHITESPACE.match(buf, end).end()
+                    if buf[end] != ':':
+                        raise ValueError("expected ':' in " + file_path)
+                    end = _WHITESPACE.match(buf, end + 1).end()
+                    value, end = decoder.raw_decode(buf, end)
+                    pos, expect = end, ','
+                    yield key, value
+                else:
+                    raise ValueError("unexpected {!r} in {}".format(
+                        buf[pos], file_path))
+            except (IndexError, json.JSONDecodeError):
+                if eof:
+                    raise ValueError("truncated snapshot " + file_path)
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+
+
+class RWLock():
+    """ Many readers or one writer
+
+    A waiting writer holds off new readers. The writing thread may read
+    and write again, a reading thread may read again, but a reader
+    cannot become a writer.
+    """
+
+    def __init__(self):
+        """ Unlocked
+        """
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._reads = {}
+        self._writers_waiting = 0
+        self._writer = None
+        self._write_depth = 0
+        self._reading = _Held(self.acquire_read, self.release_read)
+        self._writing = _Held(self.acquire_write, self.release_write)
+
+    def acquire_read(self) -> None:
+        """ Wait until no writer holds or waits for the lock
+        """
+        me = threading.get_ident()
+        if self._writer == me:
+            self._write_depth += 1
+            return
+        with self._lock:
+            reads = self._reads.get(me, 0)
+            if reads == 0:
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+            self._reads[me] = reads + 1
+
+    def release_read(self) -> None:
+        """ Release one acquire_read
+        """
+        me = threading.get_ident()
+        if self._writer == me:
+            self._write_depth -= 1
+            return
+        with self._lock:
+            reads = self._reads.pop(me) - 1
+            if reads:
+                self._reads[me] = reads
+            elif not self._reads and self._writers_waiting:
+                self._cond.notify_all()
+
+    def acquire_write(self) -> None:
+        """ Wait until no one else holds the lock
+        """
+        me = threading.get_ident()
+        if self._writer == me:
+            self._write_depth += 1
+            return
+        with self._lock:
+            if me in self._reads:
+                raise RuntimeError("cannot write while holding a read lock")
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._reads:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._write_depth = 1
+
+    def release_write(self) -> None:
+        """ Release one acquire_write
+        """
+        self._write_depth -= 1
+        if self._write_depth == 0:
+            with self._lock:
+                self._writer = None
+                self._cond.notify_all()
+
+    def reading(self) -> '_Held':
+        """ Context manager holding the lock for reading
+        """
+        return self._reading
+
+    def writing(self) -> '_Held':
+        """ Context manager holding the lock for writing
+        """
+        return self._writing
+
+
+class _Held():
+    """ Context manager calling acquire on entry and release on exit
+    """
+
+    def __init__(self, acquire, release):
+        """ Wrap an acquire/release pair
+        """
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self) -> None:
+        """ Acquire
+        """
+        self.acquire()
+
+    def __exit__(self, *exc_info) -> None:
+        """ Release
+        """
+        self.release()
+
+
+class LazyObjects(dict):
+    """ Objects of one class in DATA, some of them still the raw dicts
+    read from a JSON snapshot, or the offsets of their records in a binary
+    one: an instance is only built on first access
+    """
+
+    def __init__(self, cls: type):
+        """ Empty store for cls
+        """
+        super().__init__()
+        self.cls = cls
+        self.snapshot = None
+        self._building = threading.Lock()
+
+    def raw(self, key: str, value):
+        """ JSON dictionary, or PackedRecord, of a value not built yet
+        """
+        if type(value) is int:
+            return self.snapshot.record(value, key)
+        return value
+
+    def _build(self, key: str, value):
+        """ Replace a raw dict or record offset by its instance, once even
+        when readers race for it
+        """
+        if type(value) in (dict, int):
+            with self._building:
+                value = dict.get(self, key, value)
+                if type(value) is int:
+                    value = self.snapshot.record(value, key).to_dict(True)
+                if type(value) is dict:
+                    value = self.cls(**value)
+                    dict.__setitem__(self, key, value)
+        return value
+
+    def __getitem__(self, key: str):
+        """ Instance for key
+        """
+        return self._build(key, dict.__getitem__(self, key))
+
+    def get(self, key: str, default=None):
+        """ Instance for key, or default
+        """
+        if key not in self:
+            return default
+        return self[key]
+
+    def pop(self, key: str, default=None):
+        """ Remove and return the instance for key, or default
+        """
+        if key not in self:
+            return default
+        value = self[key]
+        del self[key]
+        return value
+
+    def values(self) -> List:
+        """ Every instance
+        """
+        return [self._build(k, v) for k, v in list(dict.items(self))]
+
+    def items(self) -> List[Tuple]:
+        """ Every (id, instance) pair
+        """
+        return [(k, self._build(k, v)) for k, v in list(dict.items(self))]
+
+
+class WriteBehind():
+    """ Background flusher grouping journal writes
+
+    Entries are queued per class and written together every `interval`
+    seconds, or as soon as `max_pending` are waiting. Entries that could
+    not be written stay queued, ahead of newer ones, and are retried on
+    the next flush.
+    """
+
+    def __init__(self, interval: float = 0.05, max_pending: int = 1000):
+        """ Start the flusher thread
+        """
+        self.interval = interval
+        self.max_pending = max_pending
+        self._cond = threading.Condition()
+        self._io_lock = threading.Lock()
+        self._pending = {}
+        self._flushing = {}
+        self._count = 0
+        self._queued = 0
+        self._flushed = 0
+        self._failed = 0
+        self._error = None
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def add(self, cls: type, entry: dict) -> int:
+        """ Queue a journal entry, returning its sequence number
+        """
+        line = json.dumps(entry) + '\n'
+        with self._cond:
+            self._pending.setdefault(cls, []).append(line)
+            self._count += 1
+            self._queued += 1
+            if self._count >= self.max_pending:
+                self._cond.notify_all()
+            return self._queued
+
+    def wait(self, seq: int) -> None:
+        """ Block until the entry numbered seq is on disk; raise OSError if
+        the last flush that tried to write it failed
+        """
+        with self._cond:
+            while self._flushed < seq:
+                if self._error is not None and seq <= self._failed:
+                    raise OSError("journal entry {} not written: {}".format(
+                        seq, self._error)) from self._error
+                self._cond.wait()
+
+    def flush(self) -> None:
+        """ Write everything queued so far. If a class cannot be written,
+        its lines and those not tried yet go back to the front of the
+        queue and the error is raised
+        """
+        with self._io_lock:
+            with self._cond:
+                pending, self._pending = self._pending, {}
+                self._flushing = pending
+                self._count = 0
+                seq = self._queued
+            items = list(pending.items())
+            written = 0
+            try:
+                for cls, lines in items:
+                    cls._write_journal(lines)
+                    written += 1
+            except Exception as e:
+                with self._cond:
+                    for cls, lines in items[written:]:
+                        self._pending[cls] = lines + \
+                            self._pending.get(cls, [])
+                        self._count += len(lines)
+                    self._flushing = {}
+                    self._failed = seq
+                    self._error = e
+                    self._cond.notify_all()
+                raise
+            finally:
+                for cls, _ in items[:written]:
+                    cls._compact()
+            with self._cond:
+                self._flushing = {}
+                self._flushed = seq
+                self._error = None
+                self._cond.notify_all()
+
+    def pending(self, cls: type) -> List[str]:
+        """ Journal lines of cls not known to be on disk yet, oldest first
+        """
+        with self._cond:
+            return self._flushing.get(cls, []) + self._pending.get(cls, [])
+
+    def _run(self) -> None:
+        """ Flush every interval, or early when enough is pending
+        """
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._count >= self.max_pending, self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    "journal flush failed, retrying")
+                time.sleep(self.interval)
 
 
 class Base():
     """ Base class
     """
 
+    # no per-object __dict__: the attribute values are the objects' only
+    # storage, and get, all and search return the stored instances
+    __slots__ = ('id', 'created_at', 'updated_at', '_json_cache')
+    INDEXED_ATTRIBUTES = ()
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
@@ -25,16 +474,57 @@ class Base():
 
         self.id = kwargs.get('id', str(uuid.uuid4()))
         if kwargs.get('created_at') is not None:
-            self.created_at = datetime.strptime(kwargs.get('created_at'),
-                                                TIMESTAMP_FORMAT)
+            self.created_at = parse_timestamp(kwargs.get('created_at'))
         else:
             self.created_at = datetime.utcnow()
         if kwargs.get('updated_at') is not None:
-            self.updated_at = datetime.strptime(kwargs.get('updated_at'),
-                                                TIMESTAMP_FORMAT)
+            self.updated_at = parse_timestamp(kwargs.get('updated_at'))
         else:
             self.updated_at = datetime.utcnow()
 
+    def __setattr__(self, name: str, value):
+        """ Set an attribute, keeping the indexes of a saved object current
+        and dropping its cached JSON
+        """
+        if name not in self.INDEXED_ATTRIBUTES or not self._is_stored():
+            super().__setattr__(name, value)
+            if name in self.INDEXED_ATTRIBUTES and self._is_stored():
+                # saved by another thread meanwhile: make sure the new
+                # value is found, a stale entry is filtered out by search
+                with self._lock().writing():
+                    self._index((name,))
+        else:
+            with self._lock().writing():
+                stored = self._is_stored()
+                if stored:
+                    self._unindex((name,))
+                super().__setattr__(name, value)
+                if stored:
+                    self._index((name,))
+        object.__setattr__(self, '_json_cache', None)
+
+    def _is_stored(self) -> bool:
+        """ True if this object is the one DATA holds for its id
+        """
+        objs = DATA.get(self.__class__.__name__, {})
+        return dict.get(objs, getattr(self, 'id', None)) is self
+
+    def _index(self, attributes: Iterable[str]) -> None:
+        """ Add this object to the indexes of attributes
+        """
+        indexes = INDEXES.setdefault(self.__class__.__name__, {})
+        for attr in attributes:
+            _index_add(indexes.setdefault(attr, {}), getattr(self, attr, None),
+                       self.id)
+
+    def _unindex(self, attributes: Iterable[str]) -> None:
+        """ Remove this object from the indexes of attributes
+        """
+        indexes = INDEXES.get(self.__class__.__name__, {})
+        for attr in attributes:
+            _index_remove(indexes.get(attr, {}), getattr(self, attr, None),
+                          self.id)
+
     def __eq__(self, other: TypeVar('Base')) -> bool:
         """ Equality
         """
@@ -44,69 +534,582 @@ class Base():
             return False
         return (self.id == other.id)
 
+    @classmethod
+    def _fields(cls) -> Tuple[str, ...]:
+        """ Slot names of cls and its bases, base class first
+        """
+        fields = _FIELDS.get(cls)
+        if fields is None:
+            fields = tuple(name for klass in reversed(cls.__mro__)
+                           for name in klass.__dict__.get('__slots__', ())
+                           if name not in ('__dict__', '__weakref__',
+                                           '_json_cache'))
+            _FIELDS[cls] = fields
+        return fields
+
+    def _items(self) -> Iterator[Tuple[str, object]]:
+        """ (name, value) of every attribute set, slots then __dict__
+        """
+        for name in self._fields():
+            try:
+                yield name, getattr(self, name)
+            except AttributeError:
+                pass
+        if hasattr(self, '__dict__'):
+            yield from self.__dict__.items()
+
     def to_json(self, for_serialization: bool = False) -> dict:
         """ Convert the object a JSON dictionary
         """
-        result = {}
-        for key, value in self.__dict__.items():
-            if not for_serialization and key[0] == '_':
-                continue
-            if type(value) is datetime:
-                result[key] = value.strftime(TIMESTAMP_FORMAT)
-            else:
-                result[key] = value
+        return dict(self._json(for_serialization))
+
+    def _json(self, for_serialization: bool = False) -> dict:
+        """ to_json without the copy: the cached dict, built again only
+        after an attribute was set. It must not be modified, and values
+        changed in place (not through setattr) are not noticed.
+        """
+        try:
+            cache = self._json_cache
+        except AttributeError:
+            cache = None
+        if cache is None:
+            cache = [None, None]
+            object.__setattr__(self, '_json_cache', cache)
+        result = cache[for_serialization]
+        if result is None:
+            result = {}
+            for key, value in self._items():
+                if not for_serialization and key[0] == '_':
+                    continue
+                if type(value) is datetime:
+                    result[key] = format_timestamp(value)
+                else:
+                    result[key] = value
+            cache[for_serialization] = result
         return result
 
     @classmethod
-    def load_from_file(cls):
-        """ Load all objects from file
+    def _file_path(cls, snapshot_format: str = None) -> str:
+        """ Path of the snapshot file, in SNAPSHOT_FORMAT by default
+        """
+        snapshot_format = snapshot_format or SNAPSHOT_FORMAT
+        return ".db_{}.{}".format(
+            cls.__name__, 'bin' if snapshot_format == 'binary' else 'json')
+
+    @classmethod
+    def _other_file_path(cls) -> str:
+        """ Path of the snapshot file in the format not written
+        """
+        return cls._file_path('json' if SNAPSHOT_FORMAT == 'binary'
+                              else 'binary')
+
+    @classmethod
+    def _snapshot(cls) -> Tuple[str, Optional[Tuple[int, int, int]]]:
+        """ Path and _file_id of the snapshot to load: the newer file when
+        there is one in each format, the one that exists, or _file_path
+        when neither does
+        """
+        file_path = cls._file_path()
+        current = _file_id(file_path)
+        other = _file_id(cls._other_file_path())
+        if other is not None and (current is None or other[1] > current[1]):
+            return cls._other_file_path(), other
+        return file_path, current
+
+    @classmethod
+    def _journal_path(cls) -> str:
+        """ Path of the journal of changes since the snapshot
+        """
+        return ".db_{}.journal".format(cls.__name__)
+
+    @classmethod
+    def _lock(cls) -> RWLock:
+        """ Lock over the objects and indexes of this class in DATA
+        """
+        locks = LOCKS.get(cls.__name__)
+        if locks is None:
+            locks = LOCKS.setdefault(cls.__name__,
+                                     (RWLock(), threading.RLock()))
+        return locks[0]
+
+    @classmethod
+    def _persist_lock(cls) -> threading.RLock:
+        """ Lock serializing the snapshot and journal writes of this class,
+        taken before _lock when both are needed
+        """
+        cls._lock()
+        return LOCKS[cls.__name__][1]
+
+    @classmethod
+    def _lock_path(cls) -> str:
+        """ Path of the file locked by writers when the store is shared
+        """
+        return ".db_{}.lock".format(cls.__name__)
+
+    @classmethod
+    @contextmanager
+    def _files_locked(cls) -> Iterator[None]:
+        """ Keep other processes off the snapshot and journal, when the
+        store is shared. Taken after _persist_lock and before _lock
+        """
+        if SHARED_SYNC is None:
+            yield
+            return
+        with cls._persist_lock():
+            state = SYNC_STATE.setdefault(cls.__name__, {})
+            if state.get('lock') is not None:
+                # held by this thread already: the persist lock is ours
+                yield
+                return
+            with open(cls._lock_path(), 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                state['lock'] = f
+                try:
+                    yield
+                finally:
+                    state['lock'] = None
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    @classmethod
+    def _store(cls, obj: TypeVar('Base')) -> None:
+        """ Put obj in DATA and the indexes, replacing any object with
+        the same id
+        """
+        objs = DATA[cls.__name__]
+        previous = objs.get(obj.id)
+        if previous is not None and previous is not obj:
+            previous._unindex(cls.INDEXED_ATTRIBUTES)
+        objs[obj.id] = obj
+        obj._index(cls.INDEXED_ATTRIBUTES)
+
+    @classmethod
+    def _discard(cls, obj_id: str) -> bool:
+        """ Drop an object from DATA and the indexes, False if absent
+        """
+        obj = DATA[cls.__name__].pop(obj_id, None)
+        if obj is None:
+            return False
+        obj._unindex(cls.INDEXED_ATTRIBUTES)
+        return True
+
+    @classmethod
+    def load_from_file(cls, background: bool = False):
+        """ Load all objects from the snapshot, then replay the journal.
+        Objects stay raw dicts until first accessed. With background, the
+        file is read by a thread and model lookups wait for it to finish
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
-        if not path.exists(file_path):
+        if STORAGE is not None:
+            STORAGE.load(cls)
+            return
+        if not background:
+            cls._load()
             return
+        LOADING[s_class] = threading.Event()
+        threading.Thread(target=cls._load, daemon=True).start()
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+    @classmethod
+    def _wait_loaded(cls) -> None:
+        """ Block while a background load of this class is running, then
+        pick up the changes other processes made, if the store is shared.
+        Raises RuntimeError while the last load of the class failed
+        """
+        loading = LOADING.get(cls.__name__)
+        if loading is not None:
+            loading.wait()
+        error = LOAD_ERRORS.get(cls.__name__)
+        if error is not None:
+            raise RuntimeError("loading {} failed: {}".format(
+                cls.__name__, error)) from error
+        if SHARED_SYNC is not None:
+            cls._sync()
+
+    @classmethod
+    def _sync(cls) -> None:
+        """ Catch up with the files, at most every SHARED_SYNC seconds:
+        replay what was appended to the journal since we last read it, or
+        reload everything if another process wrote a new snapshot
+        """
+        state = SYNC_STATE.get(cls.__name__)
+        if state is None or 'offset' not in state:
+            return
+        now = time.monotonic()
+        if now - state.get('checked', 0) < SHARED_SYNC:
+            return
+        state['checked'] = now
+        journal = _file_id(cls._journal_path())
+        if state['snapshot'] is None:
+            snapshot = cls._snapshot()[1]
+        else:
+            # a new snapshot removes the one in the other format, so it
+            # always changes or removes the file we loaded
+            snapshot = _file_id(state['path'])
+        if state['snapshot'] == snapshot and \
+                (journal[2] if journal else 0) == state['offset']:
+            return
+        with cls._persist_lock(), cls._files_locked():
+            cls._refresh()
+
+    @classmethod
+    def _refresh(cls) -> bool:
+        """ _sync without the checks, with the files lock held. True if
+        everything was reloaded
+        """
+        state = SYNC_STATE.get(cls.__name__)
+        if state is None or 'offset' not in state:
+            return False
+        journal = _file_id(cls._journal_path())
+        if state['snapshot'] != cls._snapshot()[1] or \
+                (journal[2] if journal else 0) < state['offset']:
+            cls._reload()
+            return True
+        cls._catch_up()
+        return False
+
+    @classmethod
+    def _catch_up(cls) -> None:
+        """ Replay the complete journal lines past our offset; a partial
+        last line can only be left by a crash, since writers hold the
+        files lock, so it is dropped
+        """
+        state = SYNC_STATE[cls.__name__]
+        if not path.exists(cls._journal_path()):
+            return
+        with open(cls._journal_path(), 'rb+') as f:
+            f.seek(state['offset'])
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                f.truncate(state['offset'] + end)
+        if end == 0:
+            return
+        lines = data[:end].splitlines()
+        with cls._lock().writing():
+            for line in lines:
+                cls._replay(json.loads(line))
+            JOURNAL_ENTRIES[cls.__name__] += len(lines)
+        state['offset'] += end
+
+    @classmethod
+    def _reload(cls) -> None:
+        """ Load the files again after another process compacted them,
+        then reapply our changes still queued for the flusher. Objects
+        read before are detached from the store; saving one stores it
+        again
+        """
+        s_class = cls.__name__
+        with cls._lock().writing():
+            DATA[s_class] = LazyObjects(cls)
+            INDEXES[s_class] = {}
+            JOURNAL_ENTRIES[s_class] = 0
+            try:
+                cls._load_files()
+            except Exception as e:
+                LOAD_ERRORS[s_class] = e
+                raise
+            LOAD_ERRORS.pop(s_class, None)
+            if WRITE_BEHIND is not None:
+                for line in WRITE_BEHIND.pending(cls):
+                    cls._replay(json.loads(line))
+
+    @classmethod
+    def _load(cls) -> None:
+        """ Fill DATA from the snapshot and the journal. A failure is kept
+        in LOAD_ERRORS, for lookups to raise, until a load succeeds
+        """
+        s_class = cls.__name__
+        try:
+            with cls._persist_lock(), cls._files_locked(), \
+                    cls._lock().writing():
+                DATA[s_class] = LazyObjects(cls)
+                INDEXES[s_class] = {}
+                JOURNAL_ENTRIES[s_class] = 0
+                cls._load_files()
+            LOAD_ERRORS.pop(s_class, None)
+        except Exception as e:
+            LOAD_ERRORS[s_class] = e
+            raise
+        finally:
+            loading = LOADING.pop(s_class, None)
+            if loading is not None:
+                loading.set()
+
+    @classmethod
+    def _load_files(cls) -> None:
+        """ Read the snapshot lazily, then replay the journal. The snapshot
+        is the newest one, in either format. An unterminated last journal
+        line is dropped; any other damaged line raises ValueError
+        """
+        s_class = cls.__name__
+        file_path, file_id = cls._snapshot()
+        state = SYNC_STATE.setdefault(s_class, {})
+        state['path'] = file_path
+        state['snapshot'] = file_id
+        state['offset'] = 0
+        if file_path.endswith('.bin') and path.exists(file_path):
+            objs = DATA[s_class]
+            indexes = INDEXES[s_class]
+            snapshot = PackedSnapshot(file_path)
+            objs.snapshot = snapshot
+            dict.update(objs, zip(snapshot.keys, snapshot.offsets))
+            for attr in cls.INDEXED_ATTRIBUTES:
+                _index_all(indexes.setdefault(attr, {}),
+                           snapshot.index(attr), snapshot.keys)
+        elif path.exists(file_path):
+            objs = DATA[s_class]
+            indexes = INDEXES[s_class]
+            for obj_id, obj_json in iter_snapshot(file_path):
+                if obj_json.get('id') == obj_id:
+                    # one string for the key and the attribute
+                    obj_json['id'] = obj_id
+                dict.__setitem__(objs, obj_id, obj_json)
+                for attr in cls.INDEXED_ATTRIBUTES:
+                    # raw JSON values: fine for attributes stored as-is
+                    _index_add(indexes.setdefault(attr, {}),
+                               obj_json.get(attr), obj_id)
+
+        if path.exists(cls._journal_path()):
+            with open(cls._journal_path(), 'rb+') as f:
+                offset = 0
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # a write cut short: drop it so appends stay valid
+                        f.truncate(offset)
+                        break
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        raise ValueError("damaged entry at byte {} of {}"
+                                         .format(offset, cls._journal_path())
+                                         ) from None
+                    cls._replay(entry)
+                    JOURNAL_ENTRIES[s_class] += 1
+                    offset += len(line)
+                state['offset'] = offset
+
+    @classmethod
+    def _replay(cls, entry: dict) -> None:
+        """ Apply one journal entry to DATA
+        """
+        if entry['op'] == 'save':
+            cls._store(cls(**entry['obj']))
+        elif entry['op'] == 'remove':
+            cls._discard(entry['id'])
 
     @classmethod
     def save_to_file(cls):
-        """ Save all objects to file
+        """ Save all objects to a new snapshot, remove any snapshot in the
+        other format and empty the journal. Refused with RuntimeError
+        while the objects are only partly loaded
         """
+        if STORAGE is not None:
+            return
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        file_path = cls._file_path()
+        with cls._persist_lock(), cls._files_locked():
+            if SHARED_SYNC is not None:
+                cls._refresh()
+            if s_class in LOAD_ERRORS:
+                raise RuntimeError("{} did not load, not overwriting its "
+                                   "snapshot".format(s_class))
+            with cls._lock().reading():
+                store = DATA[s_class]
+                objs = list(dict.items(store))
+            objs_json = {}
+            for obj_id, obj in objs:
+                if type(obj) is int:
+                    obj = store.raw(obj_id, obj)
+                    if SNAPSHOT_FORMAT != 'binary':
+                        obj = obj.to_dict()
+                elif type(obj) is not dict:
+                    obj = obj._json(True)
+                objs_json[obj_id] = obj
+
+            tmp_path = file_path + '.tmp'
+            try:
+                if SNAPSHOT_FORMAT == 'binary':
+                    with open(tmp_path, 'wb') as f:
+                        write_packed(f, objs_json.items(),
+                                     cls.INDEXED_ATTRIBUTES)
+                else:
+                    with open(tmp_path, 'w') as f:
+                        json.dump(objs_json, f)
+                os.replace(tmp_path, file_path)
+            except Exception:
+                if path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            if path.exists(cls._other_file_path()):
+                os.remove(cls._other_file_path())
+            open(cls._journal_path(), 'w').close()
+            JOURNAL_ENTRIES[s_class] = 0
+            state = SYNC_STATE.setdefault(s_class, {})
+            state['path'] = file_path
+            state['snapshot'] = _file_id(file_path)
+            state['offset'] = 0
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+    @classmethod
+    def _append_journal(cls, entry: dict) -> int:
+        """ Record one change: queued for the flusher in write-behind mode,
+        written now otherwise. Returns the number to pass to
+        _wait_journal, 0 when already written
+        """
+        if WRITE_BEHIND is None:
+            cls._write_journal([json.dumps(entry) + '\n'])
+            cls._compact()
+            return 0
+        return WRITE_BEHIND.add(cls, entry)
 
-    def save(self):
-        """ Save current object
+    @staticmethod
+    def _wait_journal(seq: int) -> None:
+        """ Block until the change numbered seq is on disk
+        """
+        if seq and WRITE_BEHIND is not None:
+            WRITE_BEHIND.wait(seq)
+
+    @classmethod
+    def _write_journal(cls, lines: List[str]) -> None:
+        """ Append journal lines in one write; when it raises, none of
+        them were written. When the store is shared, what other processes
+        appended is replayed first, so our offset can move past our own
+        lines
         """
-        s_class = self.__class__.__name__
+        s_class = cls.__name__
+        with cls._persist_lock(), cls._files_locked():
+            if SHARED_SYNC is not None and cls._refresh():
+                # the reload only saw the files: put our changes back
+                with cls._lock().writing():
+                    for line in lines:
+                        cls._replay(json.loads(line))
+            journal = cls._journal_path()
+            start = path.getsize(journal) if path.exists(journal) else 0
+            try:
+                with open(journal, 'a') as f:
+                    f.write(''.join(lines))
+                    offset = f.tell()
+            except OSError:
+                # drop a partial write, so a retry appends whole lines
+                if path.exists(journal):
+                    os.truncate(journal, start)
+                raise
+            state = SYNC_STATE.get(s_class)
+            if state is not None and 'offset' in state:
+                state['offset'] = offset
+            JOURNAL_ENTRIES[s_class] = JOURNAL_ENTRIES.get(s_class, 0) + \
+                len(lines)
+
+    @classmethod
+    def _compact(cls) -> None:
+        """ Compact the journal into a snapshot once it outgrows the data.
+        A failure is logged, not raised, and compaction is tried again
+        COMPACT_RETRY seconds later
+        """
+        s_class = cls.__name__
+        with cls._persist_lock():
+            if JOURNAL_ENTRIES.get(s_class, 0) <= max(JOURNAL_COMPACT_MIN,
+                                                      len(DATA[s_class])) \
+                    or time.monotonic() < _COMPACT_AFTER.get(s_class, 0):
+                return
+            try:
+                cls.save_to_file()
+            except Exception:
+                _COMPACT_AFTER[s_class] = time.monotonic() + COMPACT_RETRY
+                logging.getLogger(__name__).exception(
+                    "compacting %s failed, retrying in %ss",
+                    s_class, COMPACT_RETRY)
+
+    @staticmethod
+    def enable_write_behind(interval_ms: int = 50,
+                            max_pending: int = 1000) -> None:
+        """ Queue journal writes and flush them in groups from a
+        background thread; pending writes are flushed at exit
+        """
+        global WRITE_BEHIND
+        if WRITE_BEHIND is None:
+            WRITE_BEHIND = WriteBehind(interval_ms / 1000, max_pending)
+            atexit.register(Base.flush)
+
+    @staticmethod
+    def enable_sharing(sync_interval_ms: int = 0) -> None:
+        """ Share the files with other processes, as gunicorn workers do:
+        writes lock the files, and lookups pick up the changes of the
+        other processes at most every sync_interval_ms. Call it before
+        load_from_file
+        """
+        global SHARED_SYNC
+        SHARED_SYNC = sync_interval_ms / 1000
+
+    @staticmethod
+    def use_snapshot_format(snapshot_format: str) -> None:
+        """ Write snapshots as 'json' (.db_<Class>.json) or 'binary'
+        (.db_<Class>.bin, see models.binary_snapshot)
+        """
+        global SNAPSHOT_FORMAT
+        if snapshot_format not in ('json', 'binary'):
+            raise ValueError("unknown snapshot format " + snapshot_format)
+        SNAPSHOT_FORMAT = snapshot_format
+
+    @staticmethod
+    def use_storage(storage) -> None:
+        """ Keep the objects in storage instead of the files, for every
+        class: an object with the load, save, remove, count, get and
+        search methods of models.sqlite_storage.SQLiteStorage
+        """
+        global STORAGE
+        STORAGE = storage
+
+    @staticmethod
+    def flush() -> None:
+        """ Write every queued change to disk now
+        """
+        if WRITE_BEHIND is not None:
+            WRITE_BEHIND.flush()
+
+    def save(self, wait: bool = False):
+        """ Save current object; in write-behind mode, wait makes the call
+        return only once the change is on disk
+        """
+        cls = self.__class__
+        cls._wait_loaded()
         self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        if STORAGE is not None:
+            STORAGE.save(self)
+            return
+        with cls._persist_lock():
+            with cls._lock().writing():
+                cls._store(self)
+                entry = {'op': 'save', 'id': self.id,
+                         'obj': self._json(True)}
+            seq = cls._append_journal(entry)
+        if wait:
+            cls._wait_journal(seq)
 
-    def remove(self):
-        """ Remove object
+    def remove(self, wait: bool = False):
+        """ Remove object; wait as for save
         """
-        s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
-            del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+        cls = self.__class__
+        cls._wait_loaded()
+        if STORAGE is not None:
+            STORAGE.remove(self)
+            return
+        with cls._persist_lock():
+            with cls._lock().writing():
+                if not cls._discard(self.id):
+                    return
+            seq = cls._append_journal({'op': 'remove', 'id': self.id})
+        if wait:
+            cls._wait_journal(seq)
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
         s_class = cls.__name__
-        return len(DATA[s_class].keys())
+        if STORAGE is not None:
+            return STORAGE.count(cls)
+        cls._wait_loaded()
+        with cls._lock().reading():
+            return len(DATA[s_class])
 
     @classmethod
     def all(cls) -> Iterable[TypeVar('Base')]:
@@ -119,13 +1122,18 @@ class Base():
         """ Return one object by ID
         """
         s_class = cls.__name__
-        return DATA[s_class].get(id)
+        if STORAGE is not None:
+            return STORAGE.get(cls, id)
+        cls._wait_loaded()
+        with cls._lock().reading():
+            return DATA[s_class].get(id)
 
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
         """
         s_class = cls.__name__
+        cls._wait_loaded()
         def _search(obj):
             if len(attributes) == 0:
                 return True
@@ -133,5 +1141,73 @@ class Base():
                 if (getattr(obj, k) != v):
                     return False
             return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+
+        if STORAGE is not None:
+            candidates = STORAGE.search(cls, attributes)
+        else:
+            with cls._lock().reading():
+                candidates = cls._candidates(attributes)
+        return list(filter(_search, candidates))
+
+    @classmethod
+    def _candidates(cls, attributes: dict) -> Iterable[TypeVar('Base')]:
+        """ Objects that may match attributes: the smallest index hit, or
+        every object when no indexed attribute is queried. A list, so it
+        can be filtered after the read lock is released
+        """
+        s_class = cls.__name__
+        indexes = INDEXES.get(s_class, {})
+        ids = None
+        for k, v in attributes.items():
+            if k not in indexes:
+                continue
+            try:
+                hits = _index_ids(indexes[k], v)
+            except TypeError:
+                continue
+            if ids is None or len(hits) < len(ids):
+                ids = hits
+        if ids is None:
+            return list(DATA[s_class].values())
+        objs = DATA[s_class]
+        # an entry can outlive its object: skip ids no longer stored
+        return [obj for obj in map(objs.get, ids) if obj is not None]
+
+
+def _after_fork() -> None:
+    """ Make the store usable in a forked child, such as a gunicorn
+    worker: the threads of the parent are gone, so the locks they may
+    hold are replaced, loads they were running start over and a new
+    flusher is started. Changes still queued are left to the parent,
+    which writes them
+    """
+    global WRITE_BEHIND
+    LOCKS.clear()
+    for state in SYNC_STATE.values():
+        state['lock'] = None
+    classes = {}
+    subclasses = Base.__subclasses__()
+    while subclasses:
+        cls = subclasses.pop()
+        classes[cls.__name__] = cls
+        subclasses.extend(cls.__subclasses__())
+    for s_class in list(LOADING):
+        del LOADING[s_class]
+        classes[s_class].load_from_file(background=True)
+    if WRITE_BEHIND is not None:
+        WRITE_BEHIND = WriteBehind(WRITE_BEHIND.interval,
+                                   WRITE_BEHIND.max_pending)
+
+
+os.register_at_fork(after_in_child=_after_fork)
+if os.getenv('MODELS_SNAPSHOT_FORMAT'):
+    Base.use_snapshot_format(os.getenv('MODELS_SNAPSHOT_FORMAT'))
+if os.getenv('MODELS_STORAGE') == 'sqlite':
+    from models.sqlite_storage import SQLiteStorage
+    Base.use_storage(SQLiteStorage(os.getenv('MODELS_SQLITE_PATH',
+                                             '.db.sqlite3')))
+if os.getenv('MODELS_SHARED_SYNC_MS'):
+    Base.enable_sharing(int(os.getenv('MODELS_SHARED_SYNC_MS')))
+if os.getenv('MODELS_WRITE_BEHIND_MS'):
+    Base.enable_write_behind(int(os.getenv('MODELS_WRITE_BEHIND_MS')),
+                             int(os.getenv('MODELS_WRITE_BEHIND_MAX', '1000')))
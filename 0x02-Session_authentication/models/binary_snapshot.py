@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+""" Binary snapshot module
+
+A snapshot is MAGIC, the field names, one record per object:
+
+    u32 length | one value per field
+
+then a footer (ids, record offsets, values of the indexed fields) and
+the u64 offset of that footer. Each value is a tag byte followed by its
+payload, if any. Timestamps are stored as epoch seconds, uuids and hex
+digests as their bytes, and every value decodes back to the exact JSON
+value that was written.
+
+    python3 -m models.binary_snapshot .db_User.json .db_User.bin email
+"""
+from datetime import datetime, timedelta
+from typing import BinaryIO, Iterable, Iterator, List, Tuple
+import calendar
+import json
+import mmap
+import re
+import struct
+import sys
+
+
+MAGIC = b'MODELS-SNAPSHOT-1\n'
+ABSENT, NONE, TRUE, FALSE, STR, TIMESTAMP, INT, FLOAT, HEX, UUID, KEY, \
+    JSON = range(12)
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
+_I64 = struct.Struct('<q')
+_F64 = struct.Struct('<d')
+_EPOCH = datetime(1970, 1, 1)
+_MISSING = object()
+_TIMESTAMP = re.compile(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\Z', re.ASCII)
+_UUID = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                   r'[0-9a-f]{12}\Z')
+_HEX = re.compile(r'(?:[0-9a-f]{2}){8,}\Z')
+
+
+def encode_value(value, key: str = None) -> bytes:
+    """ Tag and payload of one JSON value
+    """
+    if value is None:
+        return bytes((NONE,))
+    if value is True:
+        return bytes((TRUE,))
+    if value is False:
+        return bytes((FALSE,))
+    if type(value) is str:
+        if value == key:
+            return bytes((KEY,))
+        if _TIMESTAMP.match(value):
+            try:
+                stamp = datetime.fromisoformat(value)
+            except ValueError:
+                stamp = None
+            if stamp is not None:
+                return bytes((TIMESTAMP,)) + _I64.pack(
+                    calendar.timegm(stamp.timetuple()))
+        if _UUID.match(value):
+            return bytes((UUID,)) + bytes.fromhex(value.replace('-', ''))
+        if _HEX.match(value):
+            raw = bytes.fromhex(value)
+            return bytes((HEX,)) + _U32.pack(len(raw)) + raw
+        # JSON allows lone surrogates, which strict UTF-8 refuses
+        raw = value.encode('utf-8', 'surrogatepass')
+        return bytes((STR,)) + _U32.pack(len(raw)) + raw
+    if type(value) is int and -(1 << 63) <= value < (1 << 63):
+        return bytes((INT,)) + _I64.pack(value)
+    if type(value) is float:
+        return bytes((FLOAT,)) + _F64.pack(value)
+    raw = json.dumps(value).encode()
+    return bytes((JSON,)) + _U32.pack(len(raw)) + raw
+
+
+def decode_value(buf, pos: int, key: str = None,
+                 datetimes: bool = False) -> Tuple[object, int]:
+    """ (value, position after it) of the value at pos; a field the
+    object did not have decodes to _MISSING. With datetimes, timestamps
+    decode to naive UTC datetimes instead of strings
+    """
+    tag = buf[pos]
+    pos += 1
+    if tag == STR:
+        size, = _U32.unpack_from(buf, pos)
+        return str(buf[pos + 4:pos + 4 + size], 'utf-8', 'surrogatepass'), \
+            pos + 4 + size
+    if tag == KEY:
+        return key, pos
+    if tag == TIMESTAMP:
+        seconds, = _I64.unpack_from(buf, pos)
+        stamp = _EPOCH + timedelta(seconds=seconds)
+        if datetimes:
+            return stamp, pos + 8
+        return '%04d-%02d-%02dT%02d:%02d:%02d' % (
+            stamp.year, stamp.month, stamp.day,
+            stamp.hour, stamp.minute, stamp.second), pos + 8
+    if tag == NONE:
+        return None, pos
+    if tag == UUID:
+        h = buf[pos:pos + 16].hex()
+        return '-'.join((h[:8], h[8:12], h[12:16], h[16:20], h[20:])), \
+            pos + 16
+    if tag == HEX:
+        size, = _U32.unpack_from(buf, pos)
+        return buf[pos + 4:pos + 4 + size].hex(), pos + 4 + size
+    if tag == INT:
+        return _I64.unpack_from(buf, pos)[0], pos + 8
+    if tag == FLOAT:
+        return _F64.unpack_from(buf, pos)[0], pos + 8
+    if tag == TRUE:
+        return True, pos
+    if tag == FALSE:
+        return False, pos
+    if tag == JSON:
+        size, = _U32.unpack_from(buf, pos)
+        return json.loads(buf[pos + 4:pos + 4 + size]), pos + 4 + size
+    if tag == ABSENT:
+        return _MISSING, pos
+    raise ValueError("unknown tag {} at {}".format(tag, pos - 1))
+
+
+def _skip_value(buf, pos: int) -> int:
+    """ Position after the value at pos, without decoding it
+    """
+    tag = buf[pos]
+    if tag in (STR, HEX, JSON):
+        return pos + 5 + _U32.unpack_from(buf, pos + 1)[0]
+    if tag in (TIMESTAMP, INT, FLOAT):
+        return pos + 9
+    if tag == UUID:
+        return pos + 17
+    return pos + 1
+
+
+class PackedRecord():
+    """ One object of a snapshot, decoded from the file only when asked
+    """
+
+    __slots__ = ('fields', 'buf', 'start', 'end', 'key')
+
+    def __init__(self, fields: Tuple[str, ...], buf, start: int, end: int,
+                 key: str):
+        """ Record of key whose values are buf[start:end]
+        """
+        self.fields = fields
+        self.buf = buf
+        self.start = start
+        self.end = end
+        self.key = key
+
+    def get(self, name: str, default=None):
+        """ Value of one field, or default
+        """
+        pos = self.start
+        for field in self.fields:
+            if field == name:
+                value, _ = decode_value(self.buf, pos, self.key)
+                return default if value is _MISSING else value
+            pos = _skip_value(self.buf, pos)
+        return default
+
+    def to_dict(self, datetimes: bool = False) -> dict:
+        """ The JSON dictionary this record was written from; datetimes as
+        for decode_value
+        """
+        result = {}
+        buf, key, pos = self.buf, self.key, self.start
+        for field in self.fields:
+            value, pos = decode_value(buf, pos, key, datetimes)
+            if value is not _MISSING:
+                result[field] = value
+        return result
+
+    def _json(self, for_serialization: bool = False) -> dict:
+        """ Like Base._json, for the snapshot writers
+        """
+        return self.to_dict()
+
+    def body(self) -> bytes:
+        """ The encoded record, without its length
+        """
+        return self.buf[self.start:self.end]
+
+
+class PackedSnapshot():
+    """ A binary snapshot read through a memory map
+
+    The footer holds the ids, the offsets of their records and the values
+    of the indexed fields, each in one block, so opening the snapshot
+    costs a few bulk decodes instead of one step per record.
+    """
+
+    def __init__(self, file_path: str):
+        """ Map file_path and read its header and footer
+        """
+        with open(file_path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if buf[:len(MAGIC)] != MAGIC or len(buf) < len(MAGIC) + 8:
+            raise ValueError("not a binary snapshot: " + file_path)
+        self.buf = buf
+        pos = len(MAGIC)
+        count, = _U32.unpack_from(buf, pos)
+        pos += 4
+        fields = []
+        for _ in range(count):
+            size, = _U16.unpack_from(buf, pos)
+            fields.append(str(buf[pos + 2:pos + 2 + size], 'utf-8'))
+            pos += 2 + size
+        self.fields = tuple(fields)
+
+        pos, = _U64.unpack_from(buf, len(buf) - 8)
+        if not len(MAGIC) < pos < len(buf):
+            raise ValueError("truncated snapshot " + file_path)
+        size, = _U32.unpack_from(buf, pos)
+        self.keys = json.loads(buf[pos + 4:pos + 4 + size])
+        pos += 4 + size
+        self.offsets = struct.unpack_from('<{}Q'.format(len(self.keys)),
+                                          buf, pos)
+        pos += 8 * len(self.keys)
+        count, = _U16.unpack_from(buf, pos)
+        pos += 2
+        self._indexes = {}
+        for _ in range(count):
+            size, = _U16.unpack_from(buf, pos)
+            name = str(buf[pos + 2:pos + 2 + size], 'utf-8')
+            pos += 2 + size
+            size, = _U32.unpack_from(buf, pos)
+            self._indexes[name] = (pos + 4, size)
+            pos += 4 + size
+
+    def record(self, offset: int, key: str) -> PackedRecord:
+        """ The record of key, written at offset
+        """
+        size, = _U32.unpack_from(self.buf, offset)
+        return PackedRecord(self.fields, self.buf, offset + 4,
+                            offset + 4 + size, key)
+
+    def index(self, name: str) -> List:
+        """ Value of field name for every record, in the order of keys
+        """
+        if name in self._indexes:
+            pos, size = self._indexes[name]
+            return json.loads(self.buf[pos:pos + size])
+        return [self.record(offset, key).get(name)
+                for key, offset in zip(self.keys, self.offsets)]
+
+
+def iter_packed(file_path: str) -> Iterator[Tuple[str, PackedRecord]]:
+    """ Yield the (id, record) pairs of a binary snapshot
+    """
+    snapshot = PackedSnapshot(file_path)
+    for key, offset in zip(snapshot.keys, snapshot.offsets):
+        yield key, snapshot.record(offset, key)
+
+
+def write_packed(f: BinaryIO, items: Iterable[Tuple[str, object]],
+                 indexed: Iterable[str] = ()) -> None:
+    """ Write a binary snapshot of (id, JSON dictionary or PackedRecord)
+    pairs, keeping the values of the fields in indexed in the footer;
+    records already in the layout are copied as they are
+    """
+    items = list(items)
+    fields = []
+    seen = set()
+    for _, value in items:
+        names = value.fields if type(value) is PackedRecord else value
+        for name in names:
+            if name not in seen:
+                seen.add(name)
+                fields.append(name)
+    fields = tuple(fields)
+    indexed = tuple(indexed)
+
+    header = [MAGIC, _U32.pack(len(fields))]
+    for name in fields:
+        raw = name.encode()
+        header.append(_U16.pack(len(raw)) + raw)
+    header = b''.join(header)
+    f.write(header)
+    pos = len(header)
+    offsets = []
+    values = {name: [] for name in indexed}
+    absent = bytes((ABSENT,))
+    for key, value in items:
+        if type(value) is PackedRecord and value.fields == fields:
+            body = value.body()
+            for name in indexed:
+                values[name].append(value.get(name))
+        else:
+            if type(value) is PackedRecord:
+                value = value.to_dict()
+            body = b''.join(
+                encode_value(value[name], key) if name in value else absent
+                for name in fields)
+            for name in indexed:
+                values[name].append(value.get(name))
+        f.write(_U32.pack(len(body)))
+        f.write(body)
+        offsets.append(pos)
+        pos += 4 + len(body)
+
+    raw = json.dumps([key for key, _ in items]).encode()
+    f.write(_U32.pack(len(raw)) + raw)
+    f.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+    f.write(_U16.pack(len(indexed)))
+    for name in indexed:
+        raw = name.encode()
+        f.write(_U16.pack(len(raw)) + raw)
+        raw = json.dumps(values[name]).encode()
+        f.write(_U32.pack(len(raw)) + raw)
+    f.write(_U64.pack(pos))
+
+
+def convert(src: str, dst: str, indexed: Iterable[str] = ()) -> None:
+    """ Convert the snapshot src to dst, JSON to binary or back,
+    depending on whether dst ends in .bin
+    """
+    if dst.endswith('.bin'):
+        from models.base import iter_snapshot
+        with open(dst, 'wb') as f:
+            write_packed(f, iter_snapshot(src), indexed)
+    else:
+        with open(dst, 'w') as f:
+            json.dump({key: record.to_dict()
+                       for key, record in iter_packed(src)}, f)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit("usage: {} SRC DST [INDEXED_ATTRIBUTE...]".format(
+            sys.argv[0]))
+    convert(sys.argv[1], sys.argv[2], sys.argv[3:])
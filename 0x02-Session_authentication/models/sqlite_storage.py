@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+""" SQLite storage module
+"""
+from typing import TypeVar, List
+import json
+import os
+import sqlite3
+import threading
+
+
+class SQLiteStorage():
+    """ Storage of the models in one SQLite database
+
+    Each class gets a table holding the serialized object in `data`, plus
+    one indexed column per attribute of INDEXED_ATTRIBUTES. Nothing is
+    kept in memory: every lookup is a query. A new table is filled with
+    the objects of the snapshot and journal files of its class, if any.
+    """
+
+    # values the indexed columns can be compared with in SQL
+    SQL_TYPES = (str, int, float, type(None))
+
+    def __init__(self, file_path: str = '.db.sqlite3'):
+        """ Storage in file_path, opened lazily by each thread
+        """
+        self.file_path = file_path
+        self._local = threading.local()
+        self._ready = set()
+        self._ready_lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        """ Connection of the calling thread, opened again after a fork
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.file_path, timeout=30,
+                                   cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _table(self, cls: type) -> str:
+        """ Quoted table name of cls, created or migrated on first use
+        """
+        table = '"{}"'.format(cls.__name__)
+        if cls.__name__ in self._ready:
+            return table
+        with self._ready_lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                new = conn.execute("SELECT 1 FROM sqlite_master WHERE "
+                                   "type = 'table' AND name = ?",
+                                   (cls.__name__,)).fetchone() is None
+                conn.execute("CREATE TABLE IF NOT EXISTS {} "
+                             "(id TEXT PRIMARY KEY, data TEXT NOT NULL)"
+                             .format(table))
+                columns = {row[1] for row in conn.execute(
+                    "PRAGMA table_info({})".format(table))}
+                for attr in cls.INDEXED_ATTRIBUTES:
+                    if attr not in columns:
+                        conn.execute("ALTER TABLE {} ADD COLUMN \"{}\""
+                                     .format(table, attr))
+                        conn.execute("UPDATE {0} SET \"{1}\" = json_extract("
+                                     "data, '$.\"{1}\"')".format(table, attr))
+                    conn.execute("CREATE INDEX IF NOT EXISTS \"{0}_{1}\" "
+                                 "ON {2} (\"{1}\")".format(cls.__name__,
+                                                           attr, table))
+                if new:
+                    conn.executemany(self._insert(cls, table),
+                                     map(self._row, self._file_objects(cls)))
+            self._ready.add(cls.__name__)
+        return table
+
+    @staticmethod
+    def _file_objects(cls: type) -> List[TypeVar('Base')]:
+        """ Objects of cls in its snapshot and journal files, read with
+        the file store of models.base
+        """
+        from models import base
+        s_class = cls.__name__
+        cls._load()
+        objs = base.DATA[s_class].values()
+        del base.DATA[s_class], base.INDEXES[s_class]
+        return objs
+
+    @staticmethod
+    def _insert(cls: type, table: str) -> str:
+        """ Statement inserting or replacing one row of cls
+        """
+        attrs = cls.INDEXED_ATTRIBUTES
+        return "INSERT OR REPLACE INTO {} (id, data{}) VALUES (?, ?{})".format(
+            table, ''.join(', "{}"'.format(a) for a in attrs),
+            ', ?' * len(attrs))
+
+    @staticmethod
+    def _row(obj: TypeVar('Base')) -> list:
+        """ Parameters of _insert for obj
+        """
+        doc = obj.to_json(True)
+        return [obj.id, json.dumps(doc)] + \
+            [doc.get(a) for a in obj.INDEXED_ATTRIBUTES]
+
+    def load(self, cls: type) -> None:
+        """ Make sure the table of cls exists
+        """
+        self._table(cls)
+
+    def save(self, obj: TypeVar('Base')) -> None:
+        """ Insert or replace obj
+        """
+        cls = obj.__class__
+        sql = self._insert(cls, self._table(cls))
+        conn = self._connection()
+        with conn:
+            conn.execute(sql, self._row(obj))
+
+    def remove(self, obj: TypeVar('Base')) -> None:
+        """ Delete obj
+        """
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM {} WHERE id = ?".format(
+                self._table(obj.__class__)), (obj.id,))
+
+    def count(self, cls: type) -> int:
+        """ Number of objects of cls
+        """
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM {}".format(self._table(cls))).fetchone()[0]
+
+    def get(self, cls: type, id: str) -> TypeVar('Base'):
+        """ Object of cls with this id, None if there is none
+        """
+        row = self._connection().execute(
+            "SELECT data FROM {} WHERE id = ?".format(self._table(cls)),
+            (id,)).fetchone()
+        return None if row is None else cls(**json.loads(row[0]))
+
+    def search(self, cls: type, attributes: dict) -> List[TypeVar('Base')]:
+        """ Objects of cls that may match attributes, narrowed by the
+        indexed columns only: the caller still compares every attribute
+        """
+        where = []
+        params = []
+        for k, v in attributes.items():
+            if k == 'id' or k in cls.INDEXED_ATTRIBUTES:
+                if type(v) in self.SQL_TYPES:
+                    where.append('"{}" IS ?'.format(k))
+                    params.append(v)
+        sql = "SELECT data FROM {}".format(self._table(cls))
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return [cls(**json.loads(row[0]))
+                for row in self._connection().execute(sql, params)]
+
+    def close(self) -> None:
+        """ Close the connection of the calling thread
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None